@@ -20,6 +20,10 @@ description:
             -- save active amset to active curve object
         - "Load From Curve"
             -- load amsets from selected curve objects
+
+        - "Bake Sequence"
+            -- render the amsets through the scene camera into "<Bake Path>####.png" on CPU,
+               frames spread over worker processes. also from `blender -b` (see AniMask_BakeOperator)
 '''
 
 
@@ -39,6 +43,12 @@ bl_info = {
 import bpy
 import bgl
 import bpy_extras
+import numpy as np
+import multiprocessing
+import os
+import struct
+import time
+import zlib
 
 from collections import namedtuple
 from mathutils import Vector
@@ -132,26 +142,122 @@ class AniMaskSet:
         self.image_texture = None
         self.reference_curve_name = ''
         self._ampseqs = []
+        self._index = None
+        self._pending = [] ## (ampseq, amp) recorded since the index was built
 
     def add(self, ampseq):
         assert type(ampseq) is AniMaskPointSequence
         self._ampseqs.append(ampseq)
+        ampseq._owner = self
+        self.invalidate()
     def clear(self):
         self._ampseqs = []
+        self.invalidate()
 
     def get_ampseqs(self):
         return self._ampseqs.copy()
     #def replace_with(self, ampseqs):
     #    self._ampseqs = ampseqs
 
+    def invalidate(self):
+        self._index = None
+        self._pending = []
+
+    def append_point(self, ampseq, amp):
+        '''
+        a point recorded at a new frame of `ampseq`, merged into the index on the next frame_index()
+        '''
+        if self._index is not None:
+            self._pending.append((ampseq, amp))
+
+    def frame_index(self):
+        '''
+        @return AniMaskFrameIndex of all the points of the set -- rebuilt after a sequence was
+                added, cleared or overwritten, merged with the points recorded since otherwise
+        '''
+        if self._index is None:
+            self._index = AniMaskFrameIndex([(i, amp) for i,aseq in enumerate(self._ampseqs)
+                                                      for amp in aseq.all_points()])
+        elif self._pending:
+            seq_ids = {id(aseq): i for i,aseq in enumerate(self._ampseqs)}
+            self._index = self._index.merged([(seq_ids[id(aseq)], amp) for aseq,amp in self._pending
+                                                if id(aseq) in seq_ids])
+        self._pending = []
+        return self._index
+
+class AniMaskFrameIndex:
+    '''
+    points of an amset in contiguous arrays sorted by frame, then by sequence
+    (the drawing order), so a frame range is a binary-searched slice.
+
+        frames     -- (n,) int
+        locations  -- (n, 3) float
+        sizes      -- (n,) float
+        viewvecs   -- (n, 3) float
+        seq_ids    -- (n,) int, index of the sequence in the amset
+
+    the arrays are never modified, a merge makes a new index (a bake job keeps its snapshot).
+    '''
+    def __init__(self, points=()):
+        '''
+        @param points -- [(seq_id, AniMaskPoint)]
+        '''
+        ps = [(amp.frame, i, amp.location[:], amp.size, amp.viewvec[:]) for i,amp in points]
+        n = len(ps)
+        frames = np.array([p[0] for p in ps], dtype=np.int64).reshape(n)
+        seq_ids = np.array([p[1] for p in ps], dtype=np.int64).reshape(n)
+        order = np.lexsort((seq_ids, frames))
+        self.frames = frames[order]
+        self.seq_ids = seq_ids[order]
+        self.locations = np.array([p[2] for p in ps], dtype=np.float64).reshape(n,3)[order]
+        self.sizes = np.array([p[3] for p in ps], dtype=np.float64).reshape(n)[order]
+        self.viewvecs = np.array([p[4] if len(p[4])==3 else (0,0,0) for p in ps], dtype=np.float64).reshape(n,3)[order]
+
+    def __len__(self):
+        return len(self.frames)
+
+    def keys(self):
+        '''
+        @return (n,) int, the sort order (frame, seq_id) as one ascending key
+        '''
+        return self.frames*2**32 + self.seq_ids
+
+    def merged(self, points):
+        '''
+        @param points -- [(seq_id, AniMaskPoint)] at frames not in the index yet for their sequence
+        @return new AniMaskFrameIndex with the points inserted in place, without a full sort
+        '''
+        tail = AniMaskFrameIndex(points)
+        at = np.searchsorted(self.keys(), tail.keys())
+        index = AniMaskFrameIndex()
+        for name in ('frames', 'seq_ids', 'locations', 'sizes', 'viewvecs'):
+            setattr(index, name, np.insert(getattr(self, name), at, getattr(tail, name), axis=0))
+        return index
+
+    def range(self, frame_first, frame_last):
+        '''
+        @return slice of the points with frame_first <= frame <= frame_last
+        '''
+        return slice(int(np.searchsorted(self.frames, frame_first, 'left'))
+                    ,int(np.searchsorted(self.frames, frame_last, 'right')))
+
 AniMaskPoint = namedtuple('AniMaskPoint', 'location, size, viewvec, frame')
 
 class AniMaskPointSequence:
     def __init__(self):
         self._table = {}
+        self._owner = None ## AniMaskSet, its frame index is updated on change
 
     def set(self, frame, location=Vector(), size=1.0, viewvec=Vector()):
-        self._table[frame] = AniMaskPoint(location, size, viewvec, frame)
+        overwrite = frame in self._table
+        amp = AniMaskPoint(location, size, viewvec, frame)
+        self._table[frame] = amp
+        if self._owner is None:
+            pass
+        elif overwrite:
+            self._owner.invalidate()
+        else:
+            self._owner.append_point(self, amp)
     def get(self, frame):
         if frame in self._table:
             return self._table[frame]
@@ -159,6 +265,8 @@ class AniMaskPointSequence:
             return None
     def clear(self):
         self._table = {}
+        if self._owner is not None:
+            self._owner.invalidate()
     def all_points(self):
         return list(self._table.values())
 
@@ -185,12 +293,59 @@ def clear_sequences():
     ---
 
     point in curve.splines[].points, amp in amset.ampseqs[].all_points():
-        point.co.x/y/z  <->  amp.location -- <!> point.co has 4 dimensions
+        point.co.x/y/z  <->  amp.location -- <!> point.co has 4 dimensions, transferred in bulk (see curve_arrays())
         point.weight  <->  amp.frame -- first frame of the sequence
         point.radius  <->  amp.size
         //~~.handle_left/right  <->  amp.viewvec
 """
 
+def transform_points(matrix, cos):
+    '''
+    @param matrix -- 4x4 mathutils.Matrix
+    @param cos -- (n, 3) array
+    @return (n, 3) array, `matrix*co` of every row at once
+    '''
+    m = np.array(matrix, dtype=np.float64)
+    return cos.dot(m[:3,:3].T) + m[:3,3]
+
+def curve_arrays(curvedata):
+    '''
+    read all the spline points of the curve in bulk
+
+    @return (counts, co, radius, weight) -- (s,) int array of point counts per spline,
+             (n, 4), (n,) and (n,) float32 arrays of the points of every spline in order
+    '''
+    counts = np.array([len(sp.points) for sp in curvedata.splines], dtype=np.int64)
+    n = int(counts.sum())
+    co = np.empty(n*4, dtype=np.float32)
+    radius = np.empty(n, dtype=np.float32)
+    weight = np.empty(n, dtype=np.float32)
+    i = 0
+    for sp,k in zip(curvedata.splines, counts.tolist()):
+        sp.points.foreach_get('co', co[i*4:(i+k)*4])
+        sp.points.foreach_get('radius', radius[i:i+k])
+        sp.points.foreach_get('weight', weight[i:i+k])
+        i += k
+    return counts, co.reshape(n,4), radius, weight
+
+def amset_curve_arrays(amset, matrix_world):
+    '''
+    @return (counts, co, radius, weight) of the amset as written to a curve object of `matrix_world`,
+             same layout as curve_arrays()
+    '''
+    pss = [sorted(aseq.all_points(), key=lambda amp: amp.frame) for aseq in amset.get_ampseqs()]
+    pss = [ps for ps in pss if ps]
+    counts = np.array([len(ps) for ps in pss], dtype=np.int64)
+    n = int(counts.sum())
+    ps = [amp for ps in pss for amp in ps]
+    co = np.empty((n,4), dtype=np.float32)
+    co[:,:3] = transform_points(matrix_world.inverted()
+                               ,np.array([amp.location[:] for amp in ps], dtype=np.float64).reshape(n,3))
+    radius = np.array([amp.size for amp in ps], dtype=np.float32).reshape(n)
+    weight = np.array([amp.frame for amp in ps], dtype=np.float32).reshape(n)
+    co[:,3] = weight ## <!> `SplinePoint.weight` is stored as co[3]
+    return counts, co, radius, weight
+
 def data_from_curve(context, curveobj):
     assert Pref.use_billboard, 'now only supported on `Pref.use_billboard==True`'
     assert curveobj.type == 'CURVE'
@@ -202,30 +357,56 @@ def data_from_curve(context, curveobj):
     amset.dissolve_length = curveobj.animask_dissolve_length
     amset.reference_curve_name = curveobj.name
 
-    m = curveobj.matrix_world
-    for sp in curveobj.data.splines:
+    counts, co, radius, weight = curve_arrays(curveobj.data)
+    locations = transform_points(curveobj.matrix_world, co[:,:3].astype(np.float64)).tolist()
+    sizes = radius.tolist()
+    i = 0
+    for k in counts.tolist():
         aseq = AniMaskPointSequence()
-        #frame_first = round(sp.points[0].weight)
-        frame_first = int(sp.points[0].weight)
-        for i,spoint in enumerate(sp.points):
-            #frame = spoint.weight
-            frame = frame_first+i ## <!> frames depends on first point's weight
-            location = Vector(spoint.co[0:3])
-            size = spoint.radius
+        #frame_first = round(weight[i])
+        frame_first = int(weight[i]) if k else 0
+        for j in range(k):
+            frame = frame_first+j ## <!> frames depends on first point's weight
             viewvec = Vector() ## #todo
-            aseq.set(frame, m*location, size, viewvec)
+            aseq.set(frame, Vector(locations[i+j]), sizes[i+j], viewvec)
         amset.add(aseq)
+        i += k
 
     return amset
 
 
+def curve_matches(curveobj, amset, arrays):
+    '''
+    @param arrays -- amset_curve_arrays() of the amset
+    @return True if the curve object already holds the amset, so writing it again can be skipped
+    '''
+    if curveobj.type != 'CURVE' or curveobj.data is None:
+        return False
+    if (curveobj.animask_texture_image, curveobj.animask_blendmode
+       ,curveobj.animask_dissolve_method, curveobj.animask_dissolve_length) != (
+            amset.image_texture, amset.blendmode, amset.dissolve_method, amset.dissolve_length):
+        return False
+    if any(sp.type!='POLY' for sp in curveobj.data.splines):
+        return False
+    ## <!> float32 round trip through matrix_world -- compare within a tolerance
+    return all(a.shape == b.shape and np.allclose(a, b, rtol=1e-6, atol=1e-6)
+               for a,b in zip(curve_arrays(curveobj.data), arrays))
+
 def data_to_curve(context, amset, curveobj=None):
+    if curveobj is not None:
+        arrays = amset_curve_arrays(amset, curveobj.matrix_world)
+        if curve_matches(curveobj, amset, arrays):
+            return curveobj
+
     curvedata = bpy.data.curves.new(name=Pref.default_curvedata_name,type='CURVE')
     curvedata.dimensions = '3D'
     curvedata.show_handles = False
     curve = curveobj if curveobj is not None  \
                      else bpy.data.objects.new(Pref.default_curve_name, curvedata)
+    old_curvedata = curve.data
     curve.data = curvedata
+    if old_curvedata is not None and old_curvedata is not curvedata and old_curvedata.users == 0:
+        bpy.data.curves.remove(old_curvedata)
     scene = context.scene
     if curve.name not in scene.objects:
         scene.objects.link(curve)
@@ -235,22 +416,17 @@ def data_to_curve(context, amset, curveobj=None):
     curve.animask_dissolve_method = amset.dissolve_method
     curve.animask_dissolve_length = amset.dissolve_length
 
-    m = curveobj.matrix_world.inverted()
-    for aseq in amset.get_ampseqs():
-        ps = aseq.all_points()
-        ## #todo - sort ps by p.frame
+    if curveobj is None:
+        arrays = amset_curve_arrays(amset, curve.matrix_world)
+    counts, co, radius, weight = arrays
+    i = 0
+    for k in counts.tolist():
         spline = curvedata.splines.new('POLY')
-        spline.points.add(len(ps)-1) ## <!> '-1'
-
-        for i,amp in enumerate(ps):
-            assert type(amp) is AniMaskPoint
-            spoint = spline.points[i]
-            spoint.weight = amp.frame
-            spoint.radius = amp.size
-            loc = m*amp.location
-            spoint.co.x = loc.x
-            spoint.co.y = loc.y
-            spoint.co.z = loc.z
+        spline.points.add(k-1) ## <!> '-1'
+        spline.points.foreach_set('co', co[i:i+k].ravel())
+        spline.points.foreach_set('radius', radius[i:i+k])
+        spline.points.foreach_set('weight', weight[i:i+k])
+        i += k
 
     return curve
 
@@ -308,98 +484,184 @@ def get_viewpoint_coordinate2(context):
         return None, None
 
 
-def draw_callback_3d(self, context):
-    def draw(ps, cs):
-        for p,c in zip(ps,cs):
-            bgl.glColor4f(*c)
-            bgl.glVertex3f(*p)
-        bgl.glColor4f(*cs[0])
-        bgl.glVertex3f(*ps[0])
+## corner coefficients along (u, v) of a billboard
+BILLBOARD_QUAD = np.array([(-1,-1), (1,-1), (1,1), (-1,1)], dtype=np.float64)
+BILLBOARD_FAN = np.array([[(0,0), (su,0), (su,sv), (0,sv)]
+                          for su,sv in ((1,1), (-1,1), (1,-1), (-1,-1))], dtype=np.float64).reshape(16,2)
 
+def dissolve_table(dissolve_method, dissolve_length):
+    '''
+    @return (alpha, scale) -- (dissolve_length+1,) arrays indexed by the frame distance from the current frame
+    '''
+    if dissolve_length != 0:
+        tfr = 1.0 - np.arange(dissolve_length+1)/dissolve_length
+    else:
+        tfr = np.ones(1)
+    fade = tfr**2.0
+    const = np.ones_like(tfr)
+    if dissolve_method == AMDissolveMethod.Opacity:
+        return fade, const
+    elif dissolve_method == AMDissolveMethod.Size:
+        return const, fade
+    elif dissolve_method == AMDissolveMethod.OpacitySize:
+        return fade, fade
+    else:
+        return const, const
+
+def billboard_basis(viewvecs):
+    '''
+    @param viewvecs -- (n, 3) array
+    @return (u0, v0) -- (n, 3) arrays, unit axes of billboards facing along `viewvecs`
+    '''
+    u0 = np.cross(viewvecs, (0.0, 0.0, 1.0))
+    norm = np.sqrt((u0**2).sum(axis=1, keepdims=True))
+    u0 = np.divide(u0, norm, out=np.zeros_like(u0), where=norm!=0)
+    u0[np.abs(viewvecs[:,2])==1.0] = (1.0, 0.0, 0.0)
+    v0 = np.cross(u0, viewvecs)
+    return u0, v0
+
+def billboard_corners(amset, index, window, frcurrent, view, coeffs):
+    '''
+    billboards of the points in `window` of the frame index, all at once
+
+    @param view -- (viewvec, u0, v0) of the current view as (1, 3) arrays, or None to face each point's own view vector
+    @param coeffs -- (k, 2) corner coefficients, e.g. BILLBOARD_QUAD
+    @return (corners, alpha) -- (n, k, 3) positions and (n,) opacity
+    '''
+    frames = index.frames[window]
+    if view is None:
+        viewvecs = index.viewvecs[window]
+        u0, v0 = billboard_basis(viewvecs)
+    else:
+        viewvecs, u0, v0 = view
+    alpha_table, scale_table = dissolve_table(amset.dissolve_method, amset.dissolve_length)
+    dfr = frcurrent - frames
+    half = (index.sizes[window]*scale_table[dfr])[:,None]
+
+    z_offset = frames/1000
+    #z_offset = frames/100
+    #z_offset = -dfr/50
+    #z_offset = -dfr/1000
+    q = index.locations[window] - viewvecs*z_offset[:,None]
+    u = u0*half
+    v = v0*half
+    corners = q[:,None,:] + coeffs[None,:,0:1]*u[:,None,:] + coeffs[None,:,1:2]*v[:,None,:]
+    return corners, alpha_table[dfr]
+
+## vertex attributes of the billboard quads
+BILLBOARD_QUAD_TEXCOORDS = np.array([(0,0), (1,0), (1,1), (0,1)], dtype=np.float32)
+BILLBOARD_FAN_ALPHA = np.array([1,0,0,0]*4, dtype=np.float32) ## alpha at the center vertex of each of the 4 quads
+
+def billboard_batches(amsets, frcurrent, view):
+    '''
+    geometry of consecutive amsets sharing blend mode and texture merged into one batch,
+    so the draw calls and GL state changes are bounded by the number of amsets.
+
+    @yield (blendmode, texture, verts, colors, texcoords)
+            -- texture is None for untextured billboards (and texcoords too),
+               verts (k*4, 3), colors (k*4, 4), texcoords (k*4, 2) float32 arrays of GL_QUADS
+    '''
+    def merged(key, batch):
+        blendmode, texture = key
+        verts = np.concatenate([b[0] for b in batch])
+        colors = np.concatenate([b[1] for b in batch])
+        texcoords = np.tile(BILLBOARD_QUAD_TEXCOORDS, (len(verts)//4, 1)) if texture else None
+        return blendmode, texture, verts, colors, texcoords
+
+    key = None
+    batch = []
+    for amset in amsets:
+        index = amset.frame_index()
+        window = index.range(frcurrent-amset.dissolve_length, frcurrent)
+        if window.start == window.stop:
+            continue
+        texture = amset.image_texture if amset.image_texture and amset.image_texture.bindcode[0] else None
+        corners, alphas = billboard_corners(amset, index, window, frcurrent, view
+                                           ,BILLBOARD_QUAD if texture else BILLBOARD_FAN)
+        colors = np.ones(corners.shape[:2]+(4,), dtype=np.float32)
+        if texture:
+            colors[:,:,3] = alphas[:,None]
+        else:
+            colors[:,:,3] = alphas[:,None]*BILLBOARD_FAN_ALPHA
+        k = (amset.blendmode, texture)
+        if k != key and batch:
+            yield merged(key, batch)
+            batch = []
+        key = k
+        batch.append((corners.reshape(-1,3), colors.reshape(-1,4)))
+    if batch:
+        yield merged(key, batch)
+
+def gl_draw_quads_3d(verts, colors, texcoords=None):
+    '''
+    @param verts -- (k*4, 3) array, colors -- (k*4, 4) array, texcoords -- (k*4, 2) array or None.
+                    submitted with a single draw call.
+    '''
+    verts = np.ascontiguousarray(verts, dtype=np.float32)
+    colors = np.ascontiguousarray(colors, dtype=np.float32)
+    if hasattr(bgl, 'glVertexPointer'):
+        arrays = [(bgl.GL_VERTEX_ARRAY, bgl.glVertexPointer, verts)
+                 ,(bgl.GL_COLOR_ARRAY, bgl.glColorPointer, colors)]
+        if texcoords is not None:
+            arrays.append((bgl.GL_TEXTURE_COORD_ARRAY, bgl.glTexCoordPointer, texcoords))
+        bufs = [] ## keep the buffers alive until drawn
+        for state, pointer, a in arrays:
+            a = np.ascontiguousarray(a, dtype=np.float32)
+            buf = bgl.Buffer(bgl.GL_FLOAT, list(a.shape), a.tolist())
+            bufs.append(buf)
+            bgl.glEnableClientState(state)
+            pointer(a.shape[1], bgl.GL_FLOAT, 0, buf)
+        bgl.glDrawArrays(bgl.GL_QUADS, 0, len(verts))
+        for state, _, _ in arrays:
+            bgl.glDisableClientState(state)
+    else:
+        bgl.glBegin(bgl.GL_QUADS)
+        if texcoords is not None:
+            for p,c,t in zip(verts.tolist(), colors.tolist(), texcoords.tolist()):
+                bgl.glColor4f(*c)
+                bgl.glTexCoord2f(*t)
+                bgl.glVertex3f(*p)
+        else:
+            for p,c in zip(verts.tolist(), colors.tolist()):
+                bgl.glColor4f(*c)
+                bgl.glVertex3f(*p)
+        bgl.glEnd()
+
+def draw_callback_3d(self, context):
     #bgl.glPushAttrib(bgl.GL_ALL_ATTRIB_BITS) ## #debug - stack context
     try:
         frcurrent = context.scene.frame_current
-        for amset in State.data.amsets:
-            frprevlimit = amset.dissolve_length
-            for fr in range(frcurrent-frprevlimit, frcurrent+1):
-                for aseq in amset.get_ampseqs():
-                    amp = aseq.get(fr)
-                    if not amp:
-                        continue
-                    viewvec = State.current_viewvec if Pref.use_billboard else amp.viewvec
-                    dfr = frcurrent-fr
-                    tfr = 1.0-dfr/frprevlimit if frprevlimit!=0 else 1.0
-
-                    ##
-                    u0 = viewvec.cross(Vector((0,0,1))).normalized() if abs(viewvec.z)!=1.0 else Vector((1,0,0))
-                    v0 = u0.cross(viewvec)
-                    size = amp.size
-                    u = u0*size
-                    v = v0*size
-                    z_offset = fr/1000
-                    #z_offset = fr/100
-                    #z_offset = -dfr/50
-                    #z_offset = -dfr/1000
-                    #q = amp.location
-                    q = amp.location - viewvec*z_offset
-                    alpha, quadscale = 1,1
-                    if amset.dissolve_method == AMDissolveMethod.Opacity:
-                        #alpha = tfr
-                        alpha = tfr**2.0
-                    elif amset.dissolve_method == AMDissolveMethod.Size:
-                        quadscale = tfr**2.0
-                    elif amset.dissolve_method == AMDissolveMethod.OpacitySize:
-                        alpha = tfr**2.0
-                        quadscale = tfr**2.0
-                    elif amset.dissolve_method == AMDissolveMethod.Const:
-                        pass
-
-                    u *= quadscale
-                    v *= quadscale
-
-                    cs = [(1,1,1,alpha), (1,1,1,.0), (1,1,1,.0), (1,1,1,.0)]
-                    bgl.glEnable(bgl.GL_BLEND)
-
-                    bgl.glDepthMask(bgl.GL_FALSE)
-
-                    if amset.blendmode==AMBlendMode.AlphaOver:
-                        ## alpha over
-                        bgl.glBlendFunc(bgl.GL_SRC_ALPHA, bgl.GL_ONE_MINUS_SRC_ALPHA)
-                        #bgl.glBlendFunc(bgl.GL_ONE, bgl.GL_ONE)
-                        bgl.glBlendEquation(bgl.GL_FUNC_ADD)
-                    elif amset.blendmode==AMBlendMode.Additive:
-                        ## additive
-                        bgl.glBlendEquation(bgl.GL_FUNC_ADD)
-                        bgl.glBlendFunc(bgl.GL_SRC_ALPHA, bgl.GL_ONE)
-                    else:
-                        print('<!> invalid blendmode: '+amset.blendmode)
-
-                    if amset.image_texture and amset.image_texture.bindcode[0]:
-                        amset.image_texture.gl_touch(0)
-                        bgl.glEnable(bgl.GL_TEXTURE_2D)
-                        bgl.glColor4f(1.0, 1.0, 1.0, alpha)
-                        bgl.glBindTexture(bgl.GL_TEXTURE_2D, amset.image_texture.bindcode[0])
-                        bgl.glBegin(bgl.GL_QUADS)
-                        ps = [q-u-v,q+u-v,q+u+v,q-u+v]
-                        bgl.glTexCoord2f(0.0, 0.0)
-                        bgl.glVertex3f(*ps[0])
-                        bgl.glTexCoord2f(1.0, 0.0)
-                        bgl.glVertex3f(*ps[1])
-                        bgl.glTexCoord2f(1.0, 1.0)
-                        bgl.glVertex3f(*ps[2])
-                        bgl.glTexCoord2f(0.0, 1.0)
-                        bgl.glVertex3f(*ps[3])
-                        bgl.glEnd()
-                        bgl.glDisable(bgl.GL_TEXTURE_2D)
-                    else:
-                        bgl.glBegin(bgl.GL_POLYGON)
-                        draw([q,q+u,q+u+v,q+v], cs)
-                        draw([q,q-u,q-u+v,q+v], cs)
-                        draw([q,q+u,q+u-v,q-v], cs)
-                        draw([q,q-u,q-u-v,q-v], cs)
-                        bgl.glEnd()
-                    bgl.glDisable(bgl.GL_BLEND)
-                    bgl.glDepthMask(bgl.GL_TRUE)
+        if Pref.use_billboard:
+            viewvec = np.array([State.current_viewvec[:]], dtype=np.float64)
+            view = (viewvec,) + billboard_basis(viewvec)
+        else:
+            view = None
+
+        bgl.glEnable(bgl.GL_BLEND)
+        bgl.glDepthMask(bgl.GL_FALSE)
+        for blendmode, texture, verts, colors, texcoords in billboard_batches(State.data.amsets, frcurrent, view):
+            if blendmode==AMBlendMode.AlphaOver:
+                ## alpha over
+                bgl.glBlendFunc(bgl.GL_SRC_ALPHA, bgl.GL_ONE_MINUS_SRC_ALPHA)
+                #bgl.glBlendFunc(bgl.GL_ONE, bgl.GL_ONE)
+                bgl.glBlendEquation(bgl.GL_FUNC_ADD)
+            elif blendmode==AMBlendMode.Additive:
+                ## additive
+                bgl.glBlendEquation(bgl.GL_FUNC_ADD)
+                bgl.glBlendFunc(bgl.GL_SRC_ALPHA, bgl.GL_ONE)
+            else:
+                print('<!> invalid blendmode: '+blendmode)
+
+            if texture:
+                texture.gl_touch(0)
+                bgl.glEnable(bgl.GL_TEXTURE_2D)
+                bgl.glBindTexture(bgl.GL_TEXTURE_2D, texture.bindcode[0])
+                gl_draw_quads_3d(verts, colors, texcoords)
+                bgl.glDisable(bgl.GL_TEXTURE_2D)
+            else:
+                gl_draw_quads_3d(verts, colors)
+        bgl.glDisable(bgl.GL_BLEND)
+        bgl.glDepthMask(bgl.GL_TRUE)
 
 
         # restore opengl defaults
@@ -416,6 +678,220 @@ def get_draw_ref_position(context):
 
 
 
+##
+## offline bake -- the billboards rasterized on CPU through the scene camera, without GL
+
+class AniMaskBakeJob:
+    '''
+    everything the frames of a bake need, as plain arrays. shared with the worker processes
+    by fork, so nothing of bpy is touched while baking.
+
+        layers   -- [VObject(index, blendmode, dissolve_method, dissolve_length, texture)],
+                    texture is (h, w, 4) float32 pixels or None
+        cameras  -- {frame: (matrix, view)}, world to clip space 4x4 array and the billboard
+                    view for billboard_corners()
+    '''
+    def __init__(self, layers, cameras, width, height, path):
+        self.layers = layers
+        self.cameras = cameras
+        self.width = width
+        self.height = height
+        self.path = path
+
+    def filepath(self, frame):
+        return '{}{:04d}.png'.format(self.path, frame)
+
+def bake_job(scene, amsets, frame_start, frame_end, path):
+    '''
+    snapshot the amsets and the scene camera of every frame in the range
+    (<!> changes the current frame, restored at the end)
+    '''
+    render = scene.render
+    width = render.resolution_x*render.resolution_percentage//100
+    height = render.resolution_y*render.resolution_percentage//100
+
+    layers = []
+    for amset in amsets:
+        layer = VObject()
+        layer.index = amset.frame_index()
+        layer.blendmode = amset.blendmode
+        layer.dissolve_method = amset.dissolve_method
+        layer.dissolve_length = amset.dissolve_length
+        img = amset.image_texture
+        if img is not None and img.size[0] and img.size[1]:
+            layer.texture = np.array(img.pixels[:], dtype=np.float32).reshape(img.size[1], img.size[0], 4)
+        else:
+            layer.texture = None
+        layers.append(layer)
+
+    cameras = {}
+    frame_current = scene.frame_current
+    try:
+        for frame in range(frame_start, frame_end+1):
+            scene.frame_set(frame)
+            camera = scene.camera
+            proj = camera.calc_matrix_camera(x=width, y=height
+                                            ,scale_x=render.pixel_aspect_x, scale_y=render.pixel_aspect_y)
+            matrix_world = np.array(camera.matrix_world, dtype=np.float64)
+            matrix = np.array(proj, dtype=np.float64).dot(np.linalg.inv(matrix_world))
+            if Pref.use_billboard:
+                viewvec = -matrix_world[:3,2]
+                viewvec = (viewvec/np.sqrt((viewvec**2).sum())).reshape(1,3)
+                view = (viewvec,) + billboard_basis(viewvec)
+            else:
+                view = None
+            cameras[frame] = (matrix, view)
+    finally:
+        scene.frame_set(frame_current)
+
+    return AniMaskBakeJob(layers, cameras, width, height, path)
+
+def rasterize_billboards(buf, layer, frame, matrix, view):
+    '''
+    blend the billboards of a layer at a frame into the buffer, as draw_callback_3d does on screen:
+    untextured billboards fade linearly from the center alpha to their edges, textured
+    ones are the texture (nearest) modulated by the alpha.
+
+    @param buf -- (h, w, 3) float32 RGB, bottom row first. blended in place.
+    @param matrix -- 4x4 array, world to clip space
+    '''
+    index = layer.index
+    window = index.range(frame-layer.dissolve_length, frame)
+    if window.start == window.stop:
+        return
+    corners, alphas = billboard_corners(layer, index, window, frame, view, BILLBOARD_QUAD)
+    q = (corners[:,0]+corners[:,2])/2
+    u = (corners[:,1]-corners[:,0])/2
+    v = (corners[:,3]-corners[:,0])/2
+
+    ## homography (s, t, 1) -> pixel (x, y, 1) of each billboard, s and t in [-1, 1]
+    h, w = buf.shape[:2]
+    a = matrix[[0,1,3]]
+    hs = np.stack([u.dot(a[:,:3].T), v.dot(a[:,:3].T), q.dot(a[:,:3].T)+a[:,3]], axis=2)
+    viewport = np.array([(w/2, 0, w/2), (0, h/2, h/2), (0, 0, 1)])
+    hs = np.matmul(viewport, hs)
+    ps = np.matmul(hs, np.vstack([BILLBOARD_QUAD.T, np.ones(4)]))
+    valid = (ps[:,2] > 1e-6).all(axis=1) & (np.abs(np.linalg.det(hs)) > 1e-12)
+    xs = ps[:,0]/np.where(valid[:,None], ps[:,2], 1)
+    ys = ps[:,1]/np.where(valid[:,None], ps[:,2], 1)
+    x0 = np.clip(np.floor(xs.min(axis=1)), 0, w).astype(np.int64)
+    x1 = np.clip(np.ceil(xs.max(axis=1)), 0, w).astype(np.int64)
+    y0 = np.clip(np.floor(ys.min(axis=1)), 0, h).astype(np.int64)
+    y1 = np.clip(np.ceil(ys.max(axis=1)), 0, h).astype(np.int64)
+    valid &= (x0 < x1) & (y0 < y1) & (alphas > 0)
+    idxs = np.flatnonzero(valid)
+    if not len(idxs):
+        return
+    inverses = np.linalg.inv(hs[idxs])
+
+    tex = layer.texture
+    additive = layer.blendmode == AMBlendMode.Additive
+    for i, hi, alpha in zip(idxs.tolist(), inverses, alphas[idxs].tolist()):
+        px = np.arange(x0[i], x1[i]) + .5
+        py = (np.arange(y0[i], y1[i]) + .5)[:,None]
+        d = hi[2,0]*px + hi[2,1]*py + hi[2,2]
+        s = (hi[0,0]*px + hi[0,1]*py + hi[0,2])/d
+        t = (hi[1,0]*px + hi[1,1]*py + hi[1,2])/d
+        inside = (np.abs(s) <= 1) & (np.abs(t) <= 1)
+        if tex is None:
+            src = None
+            sa = alpha*(1-np.maximum(np.abs(s), np.abs(t)))
+        else:
+            th, tw = tex.shape[:2]
+            tx = np.clip(((s+1)/2*tw).astype(np.int64), 0, tw-1)
+            ty = np.clip(((t+1)/2*th).astype(np.int64), 0, th-1)
+            texel = tex[ty, tx]
+            src = texel[...,:3]
+            sa = alpha*texel[...,3]
+        sa = np.where(inside, sa, 0)[...,None]
+
+        dst = buf[y0[i]:y1[i], x0[i]:x1[i]]
+        ## glBlendFunc(GL_SRC_ALPHA, GL_ONE) / (GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        if additive:
+            dst += sa if src is None else src*sa
+        else:
+            dst *= 1-sa
+            dst += sa if src is None else src*sa
+        np.clip(dst, 0, 1, out=dst) ## as a fixed point framebuffer
+
+def bake_frame(job, frame):
+    '''
+    @return (h, w, 3) float32 RGB of the frame, white billboards over black
+    '''
+    buf = np.zeros((job.height, job.width, 3), dtype=np.float32)
+    matrix, view = job.cameras[frame]
+    for layer in job.layers:
+        rasterize_billboards(buf, layer, frame, matrix, view)
+    return buf
+
+def write_png(filepath, rgb):
+    '''
+    8 bit RGB PNG, with zlib only -- the worker processes can't use bpy images
+
+    @param rgb -- (h, w, 3) float array in [0, 1], bottom row first
+    '''
+    h, w = rgb.shape[:2]
+    raw = np.zeros((h, w*3+1), dtype=np.uint8) ## filter type 0 at each row
+    raw[:,1:] = (rgb[::-1]*255+.5).astype(np.uint8).reshape(h, w*3)
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag+data) & 0xffffffff)
+    with open(filepath, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+_bake_job = None ## AniMaskBakeJob being baked, inherited by the forked workers
+
+def bake_frames(frames):
+    for frame in frames:
+        write_png(_bake_job.filepath(frame), bake_frame(_bake_job, frame))
+    return len(frames)
+
+def bake_sequence(job, processes=0):
+    '''
+    bake every frame of the job into "<path>####.png". chunks of frames are spread over
+    a pool of forked processes, or baked in this process when `processes` is 1 or fork
+    is not available (e.g. Windows).
+
+    @param processes -- number of worker processes, 0 for one per CPU
+    @return number of written frames
+    '''
+    global _bake_job
+    frames = sorted(job.cameras)
+    if not frames:
+        return 0
+    dirpath = os.path.dirname(job.path)
+    if dirpath:
+        os.makedirs(dirpath, exist_ok=True)
+    processes = min(processes or multiprocessing.cpu_count(), len(frames))
+    size = -(-len(frames)//(processes*4)) ## a few chunks per process to even out the load
+    chunks = [frames[i:i+size] for i in range(0, len(frames), size)]
+
+    _bake_job = job
+    try:
+        if processes > 1:
+            try:
+                mp = multiprocessing.get_context('fork')
+            except ValueError:
+                mp = None
+            if mp is not None:
+                with mp.Pool(processes) as pool:
+                    return sum(pool.imap_unordered(bake_frames, chunks))
+        return sum(bake_frames(chunk) for chunk in chunks)
+    finally:
+        _bake_job = None
+
+def scene_amsets(context):
+    '''
+    @return amsets of the curve objects in the scene written by "Save To Curve"
+    '''
+    return [data_from_curve(context, obj) for obj in context.scene.objects
+            if obj.type=='CURVE' and 'animask_dissolve_length' in obj
+               and all(sp.type=='POLY' for sp in obj.data.splines)]
+
+
+
 
 ##
 class AniMask_MainOperator(bpy.types.Operator):
@@ -585,7 +1061,6 @@ class AniMask_MainOperator(bpy.types.Operator):
                 for curve in [c for c in cs if c.name != (actobj.name if actobj else '')] + (
                                [actobj] if actobj and actobj.type=='CURVE' else []):
                     amset = data_from_curve(context, curve)
-                    data_to_curve(context, amset, curve) ## #test - re-update the curve object
                     State.data.amsets.append(amset)
                 State.active_amset = State.data.amsets[-1] ## #temp
 
@@ -704,6 +1179,32 @@ class AniMask_UtilOperator(bpy.types.Operator):
 
         return {'FINISHED'}
 
+class AniMask_BakeOperator(bpy.types.Operator):
+    '''
+    bake the amsets (or, when none are loaded, the AniMask curves of the scene) into
+    an image sequence through the scene camera. works under `blender -b`:
+        blender -b file.blend --python-expr "import bpy; bpy.ops.scene.animask_bake()"
+    '''
+    bl_idname = "scene.animask_bake"
+    bl_label = "AniMask Bake Sequence"
+
+    def execute(self, context):
+        scene = context.scene
+        if scene.camera is None:
+            self.report({'ERROR'}, 'no scene camera')
+            return {'CANCELLED'}
+        amsets = State.data.amsets or scene_amsets(context)
+        if not amsets:
+            self.report({'ERROR'}, 'no amsets to bake')
+            return {'CANCELLED'}
+
+        path = bpy.path.abspath(scene.animask_bake_path)
+        t = time.time()
+        job = bake_job(scene, amsets, scene.frame_start, scene.frame_end, path)
+        written = bake_sequence(job, scene.animask_bake_processes)
+        self.report({'INFO'}, '{} frames baked in {:.1f} s: {}'.format(written, time.time()-t, path))
+        return {'FINISHED'}
+
 class AniMask_Panel(bpy.types.Panel):
     bl_label = "AniMask"
     bl_space_type = "VIEW_3D"
@@ -760,6 +1261,13 @@ class AniMask_Panel(bpy.types.Panel):
             col.prop(obj, 'animask_dissolve_method', text="Dissolve Method")
             col.prop(obj, 'animask_dissolve_length', text="Dissolve Length")
 
+        layout.separator()
+        col = layout.column(align=True)
+        col.label('bake:')
+        col.prop(context.scene, 'animask_bake_path', text='')
+        col.prop(context.scene, 'animask_bake_processes', text='Processes')
+        col.operator(AniMask_BakeOperator.bl_idname, text='Bake Sequence')
+
         layout.separator()
         col = layout.column(align=True)
         col.label('utils:')
@@ -806,15 +1314,19 @@ def register():
     bpy.types.Object.animask_blendmode = bpy.props.EnumProperty(items=tautology_to_enumitems(AMBlendMode), default=Pref.default_blendmode, update=prop_updated)
     bpy.types.Object.animask_dissolve_method = bpy.props.EnumProperty(items=tautology_to_enumitems(AMDissolveMethod), default=Pref.default_dissolve_method, update=prop_updated)
     bpy.types.Object.animask_dissolve_length = bpy.props.IntProperty(default=Pref.default_dissolve_length, min=0, update=prop_updated)
+    bpy.types.Scene.animask_bake_path = bpy.props.StringProperty(name='Bake Path', default='//animask/mask_', subtype='FILE_PATH')
+    bpy.types.Scene.animask_bake_processes = bpy.props.IntProperty(name='Bake Processes', default=0, min=0, description='worker processes for Bake Sequence, 0 for one per CPU')
 
     bpy.utils.register_class(AniMask_MainOperator)
     bpy.utils.register_class(AniMask_UtilOperator)
+    bpy.utils.register_class(AniMask_BakeOperator)
     bpy.utils.register_class(AniMask_Panel)
 
 
 def unregister():
     bpy.utils.unregister_class(AniMask_MainOperator)
     bpy.utils.unregister_class(AniMask_UtilOperator)
+    bpy.utils.unregister_class(AniMask_BakeOperator)
     bpy.utils.unregister_class(AniMask_Panel)
 
 
@@ -16,12 +16,46 @@ bl_info = {
 import bpy
 import bgl
 import gpu
+import bisect
+import math
+import os
+import shutil
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from mathutils import Vector
 
 
 class Pref:
     default_output_image_name = 'komb_output'
     use_pack_image_after_stop = True
+    bake_tile_size = 128
+
+    ## input decimation -- a mouse sample is stored only when it adds shape information
+    input_min_distance = 1.5    ## screen pixels. closer samples are never stored
+    input_max_spacing = 2.0     ## brush radius. straight strokes get a point at least this often
+    input_max_angle = 20.0      ## degrees of direction change (the curve through the points smooths the rest)
+    input_radius_tolerance = .15 ## relative change of the (pressure scaled) radius
+
+    ## allowed deviation of the strokes from the curve through their points
+    curve_screen_tolerance = .5 ## screen pixels when drawing -- divided by the zoom, in powers of 2
+    curve_bake_tolerance = .5   ## image pixels at the bake resolution, also for exported masks
+
+    ## viewport drawing
+    grid_cell_size = 256        ## image pixels, cell size of the segment index used for view culling
+    lod_zoom_threshold = .5     ## below this backdrop zoom, strokes are drawn simplified
+    lod_pixel_tolerance = 1.0   ## screen pixels, point spacing of the simplified strokes
+
+    undo_memory_budget = 256*1024*1024 ## bytes, the oldest undo steps are dropped beyond this
+
+    ## strokes kept on the bake target image (ID properties)
+    document_key = 'komb_strokes'   ## baked strokes
+    pending_key = 'komb_pending'    ## strokes not baked yet when exited
+    layers_key = 'komb_layers'      ## animated stroke layers, {frame: strokes}
+
+    sequence_scratch_image_name = '.komb_sequence'
+
+    mask_simplify_tolerance = 1.0   ## image pixels, allowed deviation of exported mask splines from the strokes
 
 class _State:
     def __init__(self):
@@ -31,7 +65,19 @@ class _State:
         self.enabled = False
         self.lines = []
         self.current_line = None
+        self.stroke_filter = None
+        self.grid = None
+        self.history = None
+        self.layers = {}
+        self.image_size = (0,0)
         self.img_bake_target = None
+        self.backdrop_key = None      ## image loaded as the backdrop texture, see `backdrop_texture`
+        self.backdrop_rects = []      ## [(rect, pixels), ...] changed since the last upload
+        self.pixels = None
+        self.pixels_key = None
+        self.tiled = None  ## KombTiledMask, when baking to sparse tiles
+        self.job = None    ## KombBakeJob running in the background
+        self.viewer_pixels = None  ## cached for the fill tool, dropped on Start and frame change
 State = _State()
 
 def tautology(s):
@@ -43,6 +89,32 @@ def tautology(s):
         dic.__dict__[n] = n
     return dic
 
+KombBakeEngine = tautology('''
+    GL
+    SOFTWARE
+''')
+
+KombChannel = tautology('''
+    RGBA
+    R
+    G
+    B
+    A
+''')
+channel_index = {KombChannel.R:0, KombChannel.G:1, KombChannel.B:2, KombChannel.A:3}
+
+KombTool = tautology('''
+    DRAW
+    FILL
+''')
+
+KombBrushProfile = tautology('''
+    HARD
+    LINEAR
+    SMOOTHSTEP
+    GAUSSIAN
+''')
+
 def get_center_pos(context):
     return Vector(( context.region.width/2 + context.space_data.backdrop_x
                   , context.region.height/2 + context.space_data.backdrop_y
@@ -51,19 +123,6 @@ def get_zoom(context):
     return max(context.space_data.backdrop_zoom, .0001)
 
 
-def make_throttle():
-    import datetime
-    def throttle(ms):
-        ct = datetime.datetime.now().timestamp() * 1000
-        if ct - throttle._t >= ms:
-            throttle._t = ct
-            return False
-        return True
-    throttle._t = 0
-    return throttle
-throttle = make_throttle()
-
-
 def clear_image(img, color=(0,0,0,0)):
     img.source = 'GENERATED'
     img.generated_color = color
@@ -87,6 +146,22 @@ def set_bake_target(context, img):
 def get_bake_target(context):
     return context.window_manager.komb_bake_target
 
+def get_bake_engine(context):
+    return context.window_manager.komb_bake_engine
+def get_brush_profile(context):
+    return context.window_manager.komb_brush_profile
+def get_bake_channel(context):
+    return context.window_manager.komb_bake_channel
+def get_use_sparse_tiles(context):
+    return context.window_manager.komb_sparse_tiles
+def get_use_background_bake(context):
+    return context.window_manager.komb_bake_background
+def get_tool(context):
+    return context.window_manager.komb_tool
+
+def get_use_layers(context):
+    return context.window_manager.komb_use_layers
+
 def get_brush_radius(context):
     return context.window_manager.komb_brush_radius
 def get_brush_color(context):
@@ -107,20 +182,424 @@ class KombLine:
     def __init__(self, color):
         self.color = color[:]
         self.seq = KombPointSequence()
+        self._tolerance = Pref.curve_screen_tolerance ## image pixels, of the cached curve
+        self._curve = GrowableArray((3,))
+        self._curve_n = 0      ## len(seq) the curve was built for
+        self._curve_src = 0    ## source segments sampled for good
+        self._curve_final = 0  ## curve points that stay as more points are added
+        self._quads = GrowableArray((4,2))
+        self._quads_n = 0      ## len(seq) the quads were built for
+        self._quads_final = 0  ## quads built from final curve points
+        self._lod = {}
+        self._fixed = None     ## (tolerance, len(seq), curve, quads) sampled for a bake
+
+    def set_tolerance(self, tolerance):
+        '''
+        the tolerance (image pixels) of the cached curve -- a change samples the whole curve again
+        '''
+        if tolerance != self._tolerance:
+            self._tolerance = tolerance
+            self._curve.truncate(0)
+            self._curve_n = self._curve_src = self._curve_final = 0
+            self._quads.truncate(0)
+            self._quads_n = self._quads_final = 0
+            self._lod = {}
+
+    def baked(self, tolerance):
+        '''
+        @return (curve, quads) sampled within `tolerance` image pixels, for bakes.
+                kept apart from the drawing cache (bake jobs read it from their thread)
+                until `drop_baked()`.
+        '''
+        n = len(self.seq)
+        if self._fixed is None or self._fixed[:2] != (tolerance, n):
+            ps = self.seq.array()
+            if n < 2:
+                curve = ps.copy()
+            else:
+                samples, _ = catmull_rom_points(ps, 0, n-1, tolerance)
+                curve = np.concatenate((samples, ps[-1:]))
+            self._fixed = (tolerance, n, curve, tessellate_points(curve))
+        return self._fixed[2:]
+
+    def drop_baked(self):
+        self._fixed = None
+
+    def curve(self):
+        '''
+        @return float32 array of shape (m, 3) -- the centripetal Catmull-Rom curve through the
+            points of `seq`, sampled by `catmull_rom_points` within the drawing tolerance, cached.
+            a segment's shape depends on the point after it, so only the last segment is
+            sampled again when a point is added.
+        '''
+        n = len(self.seq)
+        if n != self._curve_n:
+            self._curve.truncate(self._curve_final)
+            if n < 2:
+                self._curve.extend(self.seq.array())
+            else:
+                ps = self.seq.array()
+                final = max(n-2, self._curve_src)
+                samples, counts = catmull_rom_points(ps, self._curve_src, n-1, self._tolerance)
+                self._curve.extend(samples)
+                self._curve_final += int(counts[:final-self._curve_src].sum())
+                self._curve_src = final
+                self._curve.append(ps[-1])
+            self._curve_n = n
+        return self._curve.view()
+
+    @property
+    def final_quads(self):
+        '''
+        number of quads of `tessellation()` that stay as more points are added
+        '''
+        return max(0, self._curve_final-1)
+
+    def tessellation(self):
+        '''
+        @return float32 array of shape (len(curve())-1, 4, 2)
+            -- quads in image space (origin at the image center), cached.
+               only the part of the curve changed since the last call is tessellated.
+        '''
+        curve = self.curve()
+        if len(self.seq) != self._quads_n:
+            m = self._quads_final
+            self._quads.truncate(m)
+            if m == 0:
+                self._quads.extend(tessellate_points(curve))
+            else:
+                self._quads.extend(tessellate_points(curve[m-1:], has_prev=True))
+            self._quads_n = len(self.seq)
+            self._quads_final = self.final_quads
+        return self._quads.view()
+
+    def lod_tessellation(self, level):
+        '''
+        @return quads of the line simplified to a point spacing of `2**level` times
+                `Pref.lod_pixel_tolerance` image pixels -- for drawing zoomed out. cached per level.
+        '''
+        n = len(self.seq)
+        cached = self._lod.get(level)
+        if cached is None or cached[0] != n:
+            ps = decimate_points(self.curve(), Pref.lod_pixel_tolerance * 2**level)
+            cached = (n, tessellate_points(ps))
+            self._lod[level] = cached
+        return cached[1]
 
 class KombPointSequence:
+    '''
+    points stored contiguously as rows of (x, y, radius)
+    '''
     def __init__(self):
-        self._kps = []
+        self._buf = GrowableArray((3,))
+    def __len__(self):
+        return len(self._buf)
     def add(self, x,y,radius):
-        self._kps.append(KombPoint(x,y,radius))
-    def all(self, ):
-        return self._kps.copy()
-
-class KombPoint:
-    def __init__(self, x,y,radius):
-        self.x = x
-        self.y = y
-        self.radius = radius
+        self._buf.append((x,y,radius))
+    def extend(self, ps):
+        self._buf.extend(ps)
+    def array(self, start=0):
+        '''
+        @return float32 array of shape (n, 3) from `start` -- a view, not a copy.
+        '''
+        return self._buf.view()[start:]
+
+class KombStrokeFilter:
+    '''
+    streaming decimation of the mouse samples of one stroke, in image space.
+    '''
+    def __init__(self):
+        self._last = None
+        self._dir = None
+        self._pending = None
+
+    def feed(self, x, y, radius, zoom):
+        '''
+        @return [(x, y, radius), ...] -- samples to store, usually zero or one
+        '''
+        s = (x, y, radius)
+        if self._last is None:
+            return self._keep(s)
+
+        lx, ly, lr = self._last
+        dx, dy = x-lx, y-ly
+        d = math.hypot(dx, dy)
+        if d*zoom < Pref.input_min_distance:
+            self._pending = s
+            return []
+
+        far = d >= Pref.input_max_spacing*max(radius, lr)
+        bend = self._dir is not None  \
+                 and (dx*self._dir[0]+dy*self._dir[1])/d < math.cos(math.radians(Pref.input_max_angle))
+        pressure = abs(radius-lr) > Pref.input_radius_tolerance*lr
+
+        if bend and self._pending is not None:
+            ## the turn began after the previous sample -- keep that one as the corner first
+            return self._keep(self._pending) + self.feed(x, y, radius, zoom)
+        if far or bend or pressure:
+            return self._keep(s)
+        self._pending = s
+        return []
+
+    def flush(self):
+        '''
+        @return the samples to store when the stroke ends -- so that it ends where the pen left.
+        '''
+        return self._keep(self._pending) if self._pending is not None else []
+
+    def _keep(self, s):
+        if self._last is not None:
+            dx, dy = s[0]-self._last[0], s[1]-self._last[1]
+            d = math.hypot(dx, dy)
+            if d > 0:
+                self._dir = (dx/d, dy/d)
+        self._last = s
+        self._pending = None
+        return [s]
+
+class GrowableArray:
+    '''
+    float32 array growing along the first axis with amortized doubling.
+    '''
+    def __init__(self, shape=(), capacity=16):
+        self._data = np.empty((capacity, *shape), dtype=np.float32)
+        self._n = 0
+    def __len__(self):
+        return self._n
+    def _reserve(self, n):
+        if n > len(self._data):
+            data = np.empty((max(n, len(self._data)*2), *self._data.shape[1:]), dtype=np.float32)
+            data[:self._n] = self._data[:self._n]
+            self._data = data
+    def append(self, row):
+        self._reserve(self._n+1)
+        self._data[self._n] = row
+        self._n += 1
+    def extend(self, rows):
+        self._reserve(self._n+len(rows))
+        self._data[self._n:self._n+len(rows)] = rows
+        self._n += len(rows)
+    def view(self):
+        return self._data[:self._n]
+    def truncate(self, n):
+        self._n = min(self._n, n)
+
+
+def tessellate_points(ps, has_prev=False):
+    '''
+    turn a stroke polyline into quads, all segments at once.
+
+    @param ps -- (n, 3) array of (x, y, radius)
+    @param has_prev -- `ps[0]` is the last point of an already tessellated part;
+                       its segment only provides the start edge of the first new quad
+    @return (n-1, 4, 2) array, or (n-2, 4, 2) when `has_prev`
+        -- each quad is [prev_u, u, v, prev_v], same as the former per-segment loop
+    '''
+    p = ps[:,:2]
+    r = ps[:,2:3]
+    if len(p) < 2:
+        return np.empty((0,4,2), dtype=np.float32)
+
+    t = p[1:] - p[:-1]
+    l = np.hypot(t[:,0], t[:,1])[:,None]
+    t = np.where(l>0, t/np.where(l>0, l, 1), 0) ## zero length -> zero normal, as `Vector.normalized()`
+    n = np.stack((t[:,1], -t[:,0]), axis=1)
+
+    if has_prev:
+        na, nb = n[:-1], n[1:]
+        a, b = p[1:-1], p[2:]
+        ra, rb = r[1:-1], r[2:]
+    else:
+        na, nb = np.concatenate((n[:1], n[:-1])), n
+        a, b = p[:-1], p[1:]
+        ra, rb = r[:-1], r[1:]
+
+    quads = np.stack((a+na*ra, b+nb*rb, b-nb*rb, a-na*ra), axis=1)
+    return quads.astype(np.float32)
+
+def catmull_rom_points(ps, first, last, tolerance):
+    '''
+    sample the centripetal Catmull-Rom spline through `ps` over the segments [first, last).
+    each segment gets as many samples as its bend needs to stay within `tolerance` (Wang's
+    bound on its Bezier form), so straight runs stay sparse. the ends are extended by mirroring.
+
+    @param ps -- (n, 3) array of (x, y, radius), radius is interpolated along with the position
+    @return (samples, counts) -- (m, 3) float32 from the start of segment `first`, without the
+                                 end of segment `last-1`, and the number of samples per segment
+    '''
+    n = len(ps)
+    i = np.arange(first, last)
+    p1, p2 = ps[i].astype(np.float64), ps[i+1].astype(np.float64)
+    p0 = np.where((i > 0)[:,None], ps[np.maximum(i-1, 0)], 2*p1-p2)
+    p3 = np.where((i+2 < n)[:,None], ps[np.minimum(i+2, n-1)], 2*p2-p1)
+
+    def knot(a, b):
+        return np.sqrt(np.maximum(np.hypot(*(b[:,:2]-a[:,:2]).T), 1e-4))[:,None]
+    d01, d12, d23 = knot(p0, p1), knot(p1, p2), knot(p2, p3)
+    m1 = ((p1-p0)/d01 - (p2-p0)/(d01+d12) + (p2-p1)/d12)*d12
+    m2 = ((p2-p1)/d12 - (p3-p1)/(d12+d23) + (p3-p2)/d23)*d12
+    c1, c2 = p1+m1/3, p2-m2/3
+
+    bend = np.maximum(np.hypot(*(p1-2*c1+c2)[:,:2].T), np.hypot(*(c1-2*c2+p2)[:,:2].T))
+    counts = np.ceil(np.sqrt(.75*bend/tolerance)).clip(1, 64).astype(np.int64)
+    seg = np.repeat(np.arange(len(i)), counts)
+    t = ((np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts, counts)) / counts[seg])[:,None]
+    s = 1-t
+    samples = s*s*s*p1[seg] + 3*s*s*t*c1[seg] + 3*s*t*t*c2[seg] + t*t*t*p2[seg]
+    return samples.astype(np.float32), counts
+
+def decimate_points(ps, tolerance):
+    '''
+    drop points falling into the same `tolerance` sized cell as their predecessor.
+    the first and the last points are always kept.
+    '''
+    if len(ps) < 3:
+        return ps
+    q = np.floor(ps[:,:2]/tolerance)
+    keep = np.ones(len(ps), dtype=bool)
+    keep[1:-1] = (q[1:-1] != q[:-2]).any(axis=1)
+    return ps[keep]
+
+class KombSegmentGrid:
+    '''
+    uniform grid over the stroke segments in image space, for culling by the view.
+    lines are indexed incrementally as they grow. removing lines rebuilds the index.
+    the lines are sampled at the grid's curve tolerance, another tolerance needs a new grid.
+    '''
+    def __init__(self, cell_size, tolerance):
+        self.cell_size = cell_size
+        self.tolerance = tolerance
+        self._cells = {}   ## (cx, cy) -> {line: [segment indices, ...]}
+        self._indexed = {} ## line -> (len(line.seq), number of final quads) when indexed
+        self._bounds = None
+
+    def update(self, lines):
+        if len(self._indexed) > len(lines) or any(line not in self._indexed for line in lines[:len(self._indexed)]):
+            self._cells = {}
+            self._indexed = {}
+            self._bounds = None
+        for line in lines:
+            line.set_tolerance(self.tolerance)
+            quads = line.tessellation()
+            n = len(line.seq)
+            indexed_n, m = self._indexed.get(line, (-1, 0))
+            if n != indexed_n:
+                ## quads past the final ones change with each new point: index them again.
+                ## the stale entries only widen the culling, `visible_quads` drops those out of range
+                if len(quads) > m:
+                    self._insert(line, quads[m:], m)
+                self._indexed[line] = (n, line.final_quads)
+
+    def _insert(self, line, quads, first):
+        cs = self.cell_size
+        lo = np.floor(quads.min(axis=1)/cs).astype(np.int64)
+        hi = np.floor(quads.max(axis=1)/cs).astype(np.int64)+1
+        si, cx, cy = _grid_cells(lo[:,0], hi[:,0], lo[:,1], hi[:,1])
+        order = np.lexsort((cy, cx))
+        si, cx, cy = si[order]+first, cx[order], cy[order]
+        splits = np.flatnonzero((cx[1:] != cx[:-1]) | (cy[1:] != cy[:-1]))+1
+        for a,b in zip(np.concatenate(([0], splits)), np.concatenate((splits, [len(si)]))):
+            cell = self._cells.setdefault((int(cx[a]), int(cy[a])), {})
+            cell.setdefault(line, []).append(si[a:b])
+
+        b = (lo.min(axis=0), hi.max(axis=0))
+        if self._bounds is not None:
+            b = (np.minimum(b[0], self._bounds[0]), np.maximum(b[1], self._bounds[1]))
+        self._bounds = b
+
+    def query(self, x0, y0, x1, y1):
+        '''
+        @return {line: sorted segment indices} -- segments in the cells overlapping the rect
+        '''
+        if self._bounds is None:
+            return {}
+        cs = self.cell_size
+        (bx0, by0), (bx1, by1) = self._bounds
+        found = {}
+        for cx in range(max(int(math.floor(x0/cs)), int(bx0)), min(int(math.floor(x1/cs))+1, int(bx1))):
+            for cy in range(max(int(math.floor(y0/cs)), int(by0)), min(int(math.floor(y1/cs))+1, int(by1))):
+                cell = self._cells.get((cx,cy))
+                if cell:
+                    for line, idxs in cell.items():
+                        found.setdefault(line, []).extend(idxs)
+        return {line: np.unique(np.concatenate(idxs)) for line, idxs in found.items()}
+
+def visible_quads(context, lines, center, zoom):
+    '''
+    @return function `line -> quads` giving only what is visible in `context.region`.
+            zoomed out, whole visible lines are drawn simplified instead.
+    '''
+    tolerance = draw_tolerance(zoom)
+    if State.grid is None or State.grid.tolerance != tolerance:
+        State.grid = KombSegmentGrid(Pref.grid_cell_size, tolerance)
+    State.grid.update(lines)
+
+    region = context.region
+    visible = State.grid.query((0-center.x)/zoom, (0-center.y)/zoom
+                              , (region.width-center.x)/zoom, (region.height-center.y)/zoom)
+    empty = np.empty((0,4,2), dtype=np.float32)
+    if zoom < Pref.lod_zoom_threshold:
+        level = int(math.log2(1/zoom))
+        return lambda line: line.lod_tessellation(level) if line in visible else empty
+
+    def quads_of(line):
+        if line not in visible:
+            return empty
+        quads = line.tessellation()
+        idxs = visible[line]
+        return quads[idxs[idxs < len(quads)]]
+    return quads_of
+
+def draw_tolerance(zoom):
+    '''
+    @return image pixels -- `Pref.curve_screen_tolerance` at the zoom, rounded to a power of 2
+            so zooming resamples the curves only when the zoom halves or doubles
+    '''
+    return Pref.curve_screen_tolerance * 2.0**-round(math.log2(max(zoom, 1e-6)))
+
+def baked_curve(line):
+    return line.baked(Pref.curve_bake_tolerance)[0]
+def baked_quads(line):
+    return line.baked(Pref.curve_bake_tolerance)[1]
+
+def iter_color_batches(lines, quads_of=None):
+    '''
+    @param quads_of -- function `line -> quads`, defaults to the full tessellation
+    @yield (color, quads) -- consecutive lines sharing a color are merged into one batch.
+                             (drawing order is kept, so overlapping colors stay correct)
+    '''
+    quads_of = quads_of or (lambda line: line.tessellation())
+    color = None
+    batch = []
+    for line in lines:
+        quads = quads_of(line)
+        if not len(quads):
+            continue
+        c = tuple(line.color)
+        if c != color and batch:
+            yield color, np.concatenate(batch)
+            batch = []
+        color = c
+        batch.append(quads)
+    if batch:
+        yield color, np.concatenate(batch)
+
+def gl_draw_quads_2d(verts):
+    '''
+    @param verts -- (k, 4, 2) array in region coordinates. submitted with a single draw call.
+    '''
+    verts = np.ascontiguousarray(verts, dtype=np.float32).reshape(-1,2)
+    if hasattr(bgl, 'glVertexPointer'):
+        buf = bgl.Buffer(bgl.GL_FLOAT, list(verts.shape), verts.tolist())
+        bgl.glEnableClientState(bgl.GL_VERTEX_ARRAY)
+        bgl.glVertexPointer(2, bgl.GL_FLOAT, 0, buf)
+        bgl.glDrawArrays(bgl.GL_QUADS, 0, len(verts))
+        bgl.glDisableClientState(bgl.GL_VERTEX_ARRAY)
+    else:
+        bgl.glBegin(bgl.GL_QUADS)
+        for p in verts.tolist():
+            bgl.glVertex2f(*p)
+        bgl.glEnd()
 
 
 class Komb_Operator(bpy.types.Operator):
@@ -130,6 +609,7 @@ class Komb_Operator(bpy.types.Operator):
     mode = bpy.props.StringProperty(default='')
 
     _handle_draw = None
+    _timer = None
 
     @classmethod
     def poll(cls, context):
@@ -155,12 +635,24 @@ class Komb_Operator(bpy.types.Operator):
                 clear_image(bimg, (0,0,0,1))
             set_bake_target(context,bimg)
             State.img_bake_target = bimg
+            State.image_size = (w,h)
+            State.viewer_pixels = None
+            State.lines = document_load(bimg, Pref.pending_key, w, h)
+            if Pref.pending_key in bimg:
+                del bimg[Pref.pending_key]
+            State.layers = layers_load(bimg, w, h)
+            if get_use_layers(context):
+                activate_layer(context.scene.frame_current)
+            if on_frame_change not in bpy.app.handlers.frame_change_post:
+                bpy.app.handlers.frame_change_post.append(on_frame_change)
 
             State.enabled = True
             opt = {
                 'image_size': (w,h)
                 }
             self._handle_draw = bpy.types.SpaceNodeEditor.draw_handler_add(draw_callback, (self, context, opt), 'WINDOW', 'POST_PIXEL')
+            ## polls background bakes
+            self._timer = context.window_manager.event_timer_add(.1, context.window)
             context.window_manager.modal_handler_add(self)
             return {'RUNNING_MODAL'}
 
@@ -168,7 +660,21 @@ class Komb_Operator(bpy.types.Operator):
             State.enabled = False
             return {'FINISHED'}
 
-        if self.mode=='BAKE':
+        if self.mode in {'UNDO', 'REDO', 'BAKE', 'REBAKE', 'FLATTEN', 'POSTPROCESS'} and State.job is not None:
+            ## the job merges into the image and drops its strokes when it finishes
+            self.report({'WARNING'}, 'a bake is running (Esc to cancel)')
+            return {'CANCELLED'}
+
+        if self.mode in {'UNDO', 'REDO'}:
+            if State.current_line is None:
+                if self.mode=='UNDO':
+                    get_history().undo()
+                else:
+                    get_history().redo()
+            context.area.tag_redraw()
+            return {'FINISHED'}
+
+        if self.mode in {'BAKE', 'REBAKE'}:
             img = get_viewer_image()
             if not img:
                 self.report({'ERROR'}, '"Viewer Node" not found in image slot or zero size')
@@ -178,44 +684,190 @@ class Komb_Operator(bpy.types.Operator):
             img = get_bake_target(context)
             if img:
                 imgname = img.name
-                render_offscreen(self, context, width, height, imgname)
+                channel = get_bake_channel(context)
+                dockey = document_key(channel)
+                lines, record = State.lines, True
+                sparse = self.mode=='BAKE' and get_use_sparse_tiles(context)
+                if not sparse:
+                    flatten_tiles(keep_pixels=True)
+                if self.mode=='BAKE' and not sparse and get_use_background_bake(context):
+                    if lines:
+                        State.job = KombBakeJob(lines, width, height, imgname
+                                                , get_brush_profile(context), channel).start()
+                    return {'FINISHED'}
+                if self.mode=='REBAKE':
+                    ## bake all the strokes stored with the image (channel) again, fitted to the current size, from black
+                    before = bake_target_pixels(width, height, imgname, channel).copy()
+                    step = KombPixelsStep(imgname, [((0,0,width,height), before)], State.lines
+                                          , document_blob(img, dockey), dockey)
+                    lines, record = document_load(img, dockey, width, height) + State.lines, False
+                    if dockey in img:
+                        del img[dockey]
+                    if channel == KombChannel.RGBA:
+                        State.pixels[...] = (0,0,0,1)
+                    else:
+                        State.pixels[...,channel_index[channel]] = 0
+                if sparse:
+                    bake_lines_to_tiles(lines, width, height, imgname, record, get_brush_profile(context), channel)
+                elif get_bake_engine(context) == KombBakeEngine.SOFTWARE  \
+                        or get_brush_profile(context) != KombBrushProfile.HARD:
+                    rects = render_software(self, context, width, height, imgname, lines, record)
+                else:
+                    rects = render_offscreen(self, context, width, height, imgname, lines, record)
+                if not record:
+                    get_history().push(step)
                 if State.img_bake_target is not None:
                     State.lines = []
                     State.current_line = None
-                    State.img_bake_target.gl_free()
-                    State.img_bake_target = bpy.data.images[imgname]
+                    if not sparse:
+                        State.img_bake_target = bpy.data.images[imgname]
+                        update_backdrop(State.img_bake_target, rects if record else None)
+            return {'FINISHED'}
+
+        if self.mode=='FLATTEN':
+            flatten_tiles()
+            context.area.tag_redraw()
+            return {'FINISHED'}
+
+        if self.mode=='POSTPROCESS':
+            flatten_tiles(keep_pixels=True)
+            img = State.img_bake_target
+            wm = context.window_manager
+            if img and img.size[0]*img.size[1] != 0:
+                w,h = img.size[:]
+                channel = get_bake_channel(context)
+                pixels = bake_target_pixels(w, h, img.name, channel)
+                get_history().push(KombPixelsStep(img.name, [((0,0,w,h), pixels.copy())]))
+                c = channel_index.get(channel, 0)
+                matte = grow_shrink_feather(pixels[...,c] > .5, wm.komb_post_offset, wm.komb_post_feather)
+                if channel == KombChannel.RGBA:
+                    pixels[...,:3] = matte[...,None]
+                else:
+                    pixels[...,c] = matte
+                image_pixels_set(img, pixels)
+                update_backdrop(img)
+            return {'FINISHED'}
+
+        if self.mode=='BAKE_SEQUENCE':
+            img = get_viewer_image()
+            if not img:
+                self.report({'ERROR'}, '"Viewer Node" not found in image slot or zero size')
+                return {'CANCELLED'}
+            width, height = img.size[:]
+            scene = context.scene
+            path = bpy.path.abspath(context.window_manager.komb_sequence_path)
+            written, linked = bake_sequence(State.layers, width, height, scene.frame_start, scene.frame_end
+                                            , path, get_brush_profile(context))
+            self.report({'INFO'}, '{} frames rendered, {} held frames linked: {}'.format(written, linked, path))
+            return {'FINISHED'}
+
+        if self.mode=='BAKE_MULTIRES':
+            img = get_viewer_image()
+            if not img:
+                self.report({'ERROR'}, '"Viewer Node" not found in image slot or zero size')
+                return {'CANCELLED'}
+            width, height = img.size[:]
+            try:
+                scales = [float(t) for t in context.window_manager.komb_multires_scales.replace(',',' ').split()]
+            except ValueError:
+                self.report({'ERROR'}, 'invalid scale list: '+context.window_manager.komb_multires_scales)
+                return {'CANCELLED'}
+            scales = [sc for sc in scales if sc > 0]
+
+            flatten_tiles()
+            img = get_bake_target(context)
+            if img and scales:
+                lines = document_load(img, document_key(get_bake_channel(context)), width, height) + State.lines
+                outs = bake_multires(lines, width, height, img.name, scales, get_brush_profile(context))
+                self.report({'INFO'}, 'baked: '+', '.join(out.name for out in outs))
+            return {'FINISHED'}
+
+        if self.mode=='EXPORT_MASK':
+            img = get_viewer_image()
+            if not img:
+                self.report({'ERROR'}, '"Viewer Node" not found in image slot or zero size')
+                return {'CANCELLED'}
+            width, height = img.size[:]
+
+            flatten_tiles()
+            img = get_bake_target(context)
+            if img:
+                lines = document_load(img, document_key(get_bake_channel(context)), width, height) + State.lines
+                mask = export_mask(lines, width, height, img.name, get_brush_profile(context))
+                self.report({'INFO'}, 'mask: {} ({} splines)'.format(mask.name, sum(len(l.splines) for l in mask.layers)))
             return {'FINISHED'}
 
         self.report({'WARNING'}, 'invalid mode:'+self.mode)
         return {'FINISHED'}
 
     def modal(self, context, event):
+        if event.type == 'ESC' and State.job is not None:
+            ## the first Esc cancels the background bake, not Komb
+            if event.value == 'PRESS':
+                State.job.cancelled = True
+            return {'RUNNING_MODAL'}
+
         if event.type == 'ESC':
             State.enabled = False
 
+        ## before the timer: Exit ends Komb (and a running bake) on its next tick
         if not State.enabled:
             self.clean(context)
             context.area.tag_redraw()
             return {'FINISHED'}
 
+        if event.type == 'TIMER':
+            job = State.job
+            if job is not None:
+                if job.done:
+                    finish_bake_job(job)
+                    if job.error is not None:
+                        self.report({'ERROR'}, 'bake failed: {}'.format(job.error))
+                    elif job.stale:
+                        self.report({'WARNING'}, 'strokes changed while baking, not baked')
+                    elif job.cancelled:
+                        self.report({'INFO'}, 'bake cancelled')
+                context.area.tag_redraw()
+            return {'PASS_THROUGH'}
+
+        if event.type == 'LEFTMOUSE' and get_tool(context) == KombTool.FILL:
+            if event.value == 'PRESS' and event.ctrl and get_use_layers(context):
+                ## layers hold strokes only, there are no pixels to fill
+                self.report({'WARNING'}, 'Fill is not available with Animated Layers')
+                return {'RUNNING_MODAL'}
+            if event.value == 'PRESS' and event.ctrl:
+                center = get_center_pos(context)
+                zoom = get_zoom(context)
+                w,h = State.image_size
+                x = int(math.floor((event.mouse_region_x-center.x)/zoom + w/2))
+                y = int(math.floor((event.mouse_region_y-center.y)/zoom + h/2))
+                fill_at(context, x, y)
+                context.area.tag_redraw()
+                return {'RUNNING_MODAL'}
+
         if event.type == 'LEFTMOUSE':
             if event.value == 'PRESS' and event.ctrl:
+                if get_use_layers(context):
+                    ensure_layer_key(context.scene.frame_current)
                 line = KombLine(get_brush_color(context))
                 State.lines.append(line)
                 State.current_line = line
+                State.stroke_filter = KombStrokeFilter()
                 #return {'PASS_THROUGH'}
                 return {'RUNNING_MODAL'}
             elif event.value == 'RELEASE':
-                State.current_line = None
+                frame = context.scene.frame_current if get_use_layers(context) else None
+                finish_stroke(layer_key_at(frame) if frame is not None else None)
                 return {'PASS_THROUGH'}
 
         if event.type == 'MOUSEMOVE':
-            if not throttle(1000/30) and State.current_line is not None:
+            if State.current_line is not None:
                 center = get_center_pos(context)
                 zoom = get_zoom(context)
                 p = Vector((event.mouse_region_x-center.x, event.mouse_region_y-center.y)) * (1/zoom)
                 r = radius_falloff(event.pressure) * get_brush_radius(context)
-                State.current_line.seq.add(p.x, p.y, r)
+                for x,y,r in State.stroke_filter.feed(p.x, p.y, r, zoom):
+                    State.current_line.seq.add(x, y, r)
                 context.area.tag_redraw()
                 return {'PASS_THROUGH'}
 
@@ -226,6 +878,12 @@ class Komb_Operator(bpy.types.Operator):
             return {'RUNNING_MODAL'}
 
         if event.ctrl and event.type in {'Z', 'Y'}:
+            if event.value == 'PRESS' and State.current_line is None and State.job is None:
+                if event.type == 'Y' or event.shift:
+                    get_history().redo()
+                else:
+                    get_history().undo()
+                context.area.tag_redraw()
             return {'RUNNING_MODAL'}
 
         if context.area:
@@ -237,8 +895,23 @@ class Komb_Operator(bpy.types.Operator):
             bpy.types.SpaceNodeEditor.draw_handler_remove(self._handle_draw, 'WINDOW')
             self._handle_draw = None
 
+        if self._timer is not None:
+            context.window_manager.event_timer_remove(self._timer)
+            self._timer = None
+        if State.job is not None:
+            State.job.cancelled = True
+            State.job.thread.join()
+            State.job = None
+
+        if on_frame_change in bpy.app.handlers.frame_change_post:
+            bpy.app.handlers.frame_change_post.remove(on_frame_change)
+
+        flatten_tiles(record=False)
         if State.img_bake_target:
             State.img_bake_target.gl_free()
+            layers_save(State.img_bake_target, State.layers, *State.image_size)
+            if State.lines and not get_use_layers(context):
+                document_save(State.img_bake_target, Pref.pending_key, State.lines, *State.image_size)
             if Pref.use_pack_image_after_stop and not State.img_bake_target.filepath:
                 State.img_bake_target.pack(True)
         State.reset()
@@ -253,8 +926,31 @@ class Komb_ClearImageConfirm(bpy.types.Operator):
         return context.window_manager.invoke_confirm(self, event)
 
     def execute(self, context):
-        if State.img_bake_target:
-            clear_image(State.img_bake_target, (0,0,0,1))
+        if State.job is not None:
+            self.report({'WARNING'}, 'a bake is running (Esc to cancel)')
+            return {'CANCELLED'}
+        flatten_tiles(keep_pixels=True)
+        img = State.img_bake_target
+        if img:
+            w,h = img.size[:]
+            if State.pixels is None or State.pixels_key != (img.name, w, h):
+                State.pixels = image_pixels_get(img)
+            channel = get_bake_channel(context)
+            dockey = document_key(channel)
+            get_history().push(KombPixelsStep(img.name, [((0,0,w,h), State.pixels.copy())], ()
+                                              , document_blob(img, dockey), dockey))
+
+            if dockey in img:
+                del img[dockey]
+            if channel == KombChannel.RGBA:
+                clear_image(img, (0,0,0,1))
+                State.pixels = np.zeros((h, w, 4), dtype=np.float32)
+                State.pixels[...,3] = 1
+                State.pixels_key = (img.name, w, h)
+            else:
+                State.pixels[...,channel_index[channel]] = 0
+                image_pixels_set(img, State.pixels)
+            update_backdrop(img)
         return {'FINISHED'}
 
 
@@ -324,10 +1020,53 @@ class Komb_Panel(bpy.types.Panel):
             op = col.operator(Komb_Operator.bl_idname, text='Exit', icon='PAUSE')
             op.mode = 'EXIT'
 
+            col.prop(context.window_manager, 'komb_use_layers', text='Animated Layers')
+            if get_use_layers(context):
+                frame = context.scene.frame_current
+                key = layer_key_at(frame)
+                col.label('layer: {}'.format('{} ({})'.format(key, 'key' if key==frame else 'held') if key is not None else '(None)'))
+                op = col.operator(Komb_Operator.bl_idname, text='Bake Sequence')
+                op.mode = 'BAKE_SEQUENCE'
+                col.prop(context.window_manager, 'komb_sequence_path', text='')
+            else:
+                row = col.row(align=True)
+                op = row.operator(Komb_Operator.bl_idname, text='Bake')
+                op.mode = 'BAKE'
+                op = row.operator(Komb_Operator.bl_idname, text='Re-Bake')
+                op.mode = 'REBAKE'
+                col.prop(context.window_manager, 'komb_bake_target', text='Bake to')
+                col.prop(context.window_manager, 'komb_bake_engine', text='Engine')
+                col.prop(context.window_manager, 'komb_bake_channel', text='Channel')
+                col.prop(context.window_manager, 'komb_sparse_tiles', text='Sparse Tiles')
+                col.prop(context.window_manager, 'komb_bake_background', text='Bake in Background')
+                if State.job is not None:
+                    col.label('baking... {:.0f}% (Esc to cancel)'.format(State.job.progress*100))
+                if State.tiled is not None:
+                    row = col.row(align=True)
+                    op = row.operator(Komb_Operator.bl_idname, text='Flatten')
+                    op.mode = 'FLATTEN'
+                    row.label('{} tiles, {:.1f} MB'.format(len(State.tiled.tiles), State.tiled.nbytes/2**20))
+                row = col.row(align=True)
+                op = row.operator(Komb_Operator.bl_idname, text='Multi-Res Bake')
+                op.mode = 'BAKE_MULTIRES'
+                row.prop(context.window_manager, 'komb_multires_scales', text='')
+                op = col.operator(Komb_Operator.bl_idname, text='Export Mask')
+                op.mode = 'EXPORT_MASK'
 
-            op = col.operator(Komb_Operator.bl_idname, text='Bake')
-            op.mode = 'BAKE'
-            col.prop(context.window_manager, 'komb_bake_target', text='Bake to')
+            row = col.row(align=True)
+            op = row.operator(Komb_Operator.bl_idname, text='Undo', icon='LOOP_BACK')
+            op.mode = 'UNDO'
+            op = row.operator(Komb_Operator.bl_idname, text='Redo', icon='LOOP_FORWARDS')
+            op.mode = 'REDO'
+
+            layout.separator()
+            col = layout.column(align=True)
+            col.label('Post Process:')
+            row = col.row(align=True)
+            row.prop(context.window_manager, 'komb_post_offset', text='Grow')
+            row.prop(context.window_manager, 'komb_post_feather', text='Feather')
+            op = col.operator(Komb_Operator.bl_idname, text='Apply to Image')
+            op.mode = 'POSTPROCESS'
 
             layout.separator()
             col = layout.column(align=True)
@@ -339,7 +1078,14 @@ class Komb_Panel(bpy.types.Panel):
 
             layout.separator()
             col = layout.column(align=True)
+            row = col.row(align=True)
+            row.prop(context.window_manager, 'komb_tool', expand=True)
+            if get_tool(context) == KombTool.FILL:
+                row = col.row(align=True)
+                row.prop(context.window_manager, 'komb_fill_tolerance', text='Tolerance')
+                row.prop(context.window_manager, 'komb_fill_contiguous', text='Contiguous')
             col.prop(context.window_manager, 'komb_brush_radius', text='Brush Radius')
+            col.prop(context.window_manager, 'komb_brush_profile', text='Profile')
             row = col.row(align=True)
             row.prop(context.window_manager, 'komb_brush_color', text='')
             row.prop(context.window_manager, 'komb_brush_color2', text='')
@@ -359,22 +1105,20 @@ def draw_callback(self, context, opt={}):
     zoom = opt.get('zoom') or get_zoom(context)
     back_image_alpha = opt.get('back_image_alpha') or .5
     image_size = opt.get('image_size') or (0,0)
+    draw_backdrop = opt.get('draw_backdrop', True)
     width,height = image_size
 
-    img = State.img_bake_target
-    if img and width*height != 0:
-        if not img.bindcode[0]:
-            img.gl_load(0, bgl.GL_NEAREST, bgl.GL_NEAREST)
-        else:
-            img.gl_touch(0)
-
+    tex, gray = backdrop_texture(context) if draw_backdrop else (0, None)
+    if tex and width*height != 0:
         bgl.glEnable(bgl.GL_BLEND)
         bgl.glBlendFunc(bgl.GL_SRC_ALPHA, bgl.GL_ONE_MINUS_SRC_ALPHA)
         bgl.glBlendEquation(bgl.GL_FUNC_ADD)
 
         bgl.glEnable(bgl.GL_TEXTURE_2D)
         bgl.glColor4f(1,1,1,back_image_alpha)
-        bgl.glBindTexture(bgl.GL_TEXTURE_2D, img.bindcode[0])
+        bgl.glBindTexture(bgl.GL_TEXTURE_2D, tex)
+        if gray is not None:
+            gl_texture_swizzle(gray)
 
         bgl.glBegin(bgl.GL_QUADS)
         dw = Vector((width,0)) / 2
@@ -389,40 +1133,25 @@ def draw_callback(self, context, opt={}):
             bgl.glTexCoord2f(*t)
             bgl.glVertex2f(*p)
         bgl.glEnd()
+        if gray is not None:
+            gl_texture_swizzle(None)
         bgl.glDisable(bgl.GL_TEXTURE_2D)
 
+    mask = State.tiled
+    if draw_backdrop and mask is not None and width*height != 0:
+        gl_draw_tiles(mask, center, zoom, (width/mask.width, height/mask.height))
+
     ##
     #bgl.glEnable(bgl.GL_BLEND)
     bgl.glBlendFunc(bgl.GL_SRC_ALPHA, bgl.GL_ONE_MINUS_SRC_ALPHA)
     bgl.glBlendEquation(bgl.GL_FUNC_ADD)
-    for line in State.lines:
-        bgl.glColor4f(*(*line.color,1.0))
-
-        ps = line.seq.all()
-        if len(ps)<2:
-            continue
-
-        ka,kb = ps[0:2]
-        a = Vector((ka.x,ka.y))
-        b = Vector((kb.x,kb.y))
-        t = (b-a).normalized()
-        n = Vector((t.y, -t.x))
-        prev_u = a+n*ka.radius
-        prev_v = a-n*ka.radius
-
-        for ka,kb in zip(ps[:-1], ps[1:]):
-            a = Vector((ka.x,ka.y))
-            b = Vector((kb.x,kb.y))
-            t = (b-a).normalized()
-            n = Vector((t.y, -t.x))
-            u = b+n*kb.radius
-            v = b-n*kb.radius
-            bgl.glBegin(bgl.GL_QUADS)
-            for p in [prev_u, u, v, prev_v]:
-                bgl.glVertex2f(*(center+p*zoom))
-            bgl.glEnd()
-            prev_u = u
-            prev_v = v
+    ## culling only for the viewport, bakes pass their own `center`
+    lines = opt.get('lines', State.lines)
+    quads_of = visible_quads(context, lines, center, zoom) if 'center' not in opt else baked_quads
+    c = np.array(center[:2], dtype=np.float32)
+    for color, quads in iter_color_batches(lines, quads_of):
+        bgl.glColor4f(*(*color,1.0))
+        gl_draw_quads_2d(c+quads*zoom)
 
     # restore opengl defaults
     bgl.glLineWidth(1)
@@ -431,33 +1160,1338 @@ def draw_callback(self, context, opt={}):
     bgl.glBlendEquation(bgl.GL_FUNC_ADD)
 
 
-def render_offscreen(self, context, width, height, imgname=''):
+def render_offscreen(self, context, width, height, imgname='', lines=None, record=True):
     assert context.area.type == 'NODE_EDITOR' and context.space_data.tree_type == 'CompositorNodeTree'
 
-    gos = gpu.offscreen.new(width,height)
-    gos.bind(True)
+    imgname = imgname or Pref.default_output_image_name
+    lines = State.lines if lines is None else lines
+    channel = get_bake_channel(context)
+    pixels, rects = begin_bake(lines, width, height, imgname, record, channel)
+    if rects:
+        ## one offscreen as large as the largest span, the strokes rendered span by span --
+        ## strokes far apart don't make a frame sized offscreen
+        bw = max(w for x,y,w,h in rects)
+        bh = max(h for x,y,w,h in rects)
+
+        gos = gpu.offscreen.new(bw,bh)
+        gos.bind(True)
+        try:
+            for (x,y,w,h), span_lines in lines_per_rect(lines, rects, width, height):
+                bgl.glClearColor(0.0, 0.0, 0.0, 0.0)
+                bgl.glClear(bgl.GL_COLOR_BUFFER_BIT)
+                bgl.glMatrixMode(bgl.GL_PROJECTION)
+                bgl.glLoadIdentity()
+                bgl.glScalef(1/bw*2,1/bh*2,1.0)
+                bgl.glTranslatef(-x-bw/2,-y-bh/2,0)
+
+                ## strokes only -- the backdrop is already in `pixels`
+                draw_callback(self, context, {
+                          'center': Vector((width/2, height/2))
+                        , 'zoom': 1.0
+                        , 'image_size': (width, height)
+                        , 'draw_backdrop': False
+                        , 'lines': span_lines
+                        })
+
+                buffer = bgl.Buffer(bgl.GL_FLOAT, w * h * 4)
+                bgl.glReadPixels(0, 0, w, h, bgl.GL_RGBA, bgl.GL_FLOAT, buffer)
+                tile = np.array(buffer[:], dtype=np.float32).reshape(h, w, 4)
+                merge_tile(pixels[y:y+h, x:x+w], tile, channel)
+        finally:
+            gos.unbind(True)
+            gos.free()
+
+    end_bake(width, height, imgname, pixels, lines, channel)
+    return rects
+
+def render_software(self, context, width, height, imgname='', lines=None, record=True):
+    '''
+    same result as `render_offscreen` but rasterized on CPU -- no GL context needed.
+    also draws the soft brush profiles.
+    '''
+    lines = State.lines if lines is None else lines
+    return bake_lines_to_image(lines, width, height, imgname or Pref.default_output_image_name, record
+                               , get_brush_profile(context), get_bake_channel(context))
+
+def bake_lines_to_image(lines, width, height, imgname, record=True, profile=KombBrushProfile.HARD
+                        , channel=KombChannel.RGBA):
+    '''
+    usable from `blender -b` scripts.
+    '''
+    pixels, rects = begin_bake(lines, width, height, imgname, record, channel)
+    if channel == KombChannel.RGBA:
+        rasterize_lines(pixels, lines, profile)
+    else:
+        ## strokes on a transparent layer per span, then into the one channel
+        for (x,y,w,h), span_lines in lines_per_rect(lines, rects, width, height):
+            layer = np.zeros((h, w, 4), dtype=np.float32)
+            rasterize_lines(layer, span_lines, profile, center=(width/2-x, height/2-y))
+            merge_tile(pixels[y:y+h, x:x+w], layer, channel)
+    end_bake(width, height, imgname, pixels, lines, channel)
+    return rects
+
+def bake_multires(lines, width, height, imgname, scales, profile=KombBrushProfile.HARD):
+    '''
+    rasterize `lines` (fitted to width x height) once per scale factor, each from black into
+    its own image "<imgname>_<percent>". the scales run on a thread pool: the rasterizer is
+    whole-array NumPy work, most of which runs without the GIL, so they can overlap on several cores.
+    @return [bpy.types.Image, ...]
+    '''
+    blob = lines_to_blob(lines, width, height)
+    sizes = [(max(1, round(width*sc)), max(1, round(height*sc))) for sc in scales]
+
+    def bake(size):
+        w,h = size
+        buf = np.zeros((h, w, 4), dtype=np.float32)
+        buf[...,3] = 1
+        rasterize_lines(buf, lines_from_blob(blob, w, h), profile)
+        return buf
+
+    with ThreadPoolExecutor(max_workers=len(sizes)) as ex:
+        bufs = list(ex.map(bake, sizes))
+
+    outs = []
+    for sc, (w,h), buf in zip(scales, sizes, bufs):
+        out = prepare_blimage(w, h, '{}_{:g}'.format(imgname, sc*100))
+        image_pixels_set(out, buf)
+        outs.append(out)
+    return outs
+
+def begin_bake(lines, width, height, imgname, record=True, channel=KombChannel.RGBA):
+    '''
+    @return (pixels, rects) -- the pixels to merge `lines` into and the dirty rects.
+                               the rects' current contents are recorded for undo.
+    '''
+    pixels = bake_target_pixels(width, height, imgname, channel)
+    rects = dirty_rects(lines, width, height, Pref.bake_tile_size)
+    if record and lines:
+        tiles = [(r, pixels[r[1]:r[1]+r[3], r[0]:r[0]+r[2]].copy()) for r in rects]
+        img = bpy.data.images.get(imgname)
+        dockey = document_key(channel)
+        get_history().push(KombPixelsStep(imgname, tiles, lines, document_blob(img, dockey), dockey))
+    return pixels, rects
+
+def end_bake(width, height, imgname, pixels, lines=(), channel=KombChannel.RGBA):
+    out = prepare_blimage(width, height, imgname)
+    image_pixels_set(out, pixels)
+    if lines:
+        document_append(out, document_key(channel), lines, width, height)
+    for line in lines:
+        line.drop_baked()
+    return out
+
+def merge_tile(dst, tile, channel=KombChannel.RGBA):
+    '''
+    merge strokes drawn over transparent black (premultiplied, as read back from GL) into `dst`.
+    for a single channel, the strokes' gray level goes to that channel only.
+    '''
+    a = tile[...,3:4]
+    if channel == KombChannel.RGBA:
+        dst *= 1-a
+        dst += tile
+    else:
+        c = channel_index[channel]
+        dst[...,c] *= 1-a[...,0]
+        dst[...,c] += tile[...,:3].mean(axis=-1)
+
+class KombBakeJob:
+    '''
+    software bake of a snapshot of lines on a worker thread: the strokes are rasterized
+    per dirty rect onto transparent layers, `finish_bake_job` merges them into the image
+    on the main thread. `cancelled` is checked between the rects.
+    '''
+    def __init__(self, lines, width, height, imgname, profile=KombBrushProfile.HARD, channel=KombChannel.RGBA):
+        self.lines = list(lines)
+        self.width = width
+        self.height = height
+        self.imgname = imgname
+        self.profile = profile
+        self.channel = channel
+        self.rects = dirty_rects(self.lines, width, height, Pref.bake_tile_size)
+        self.layers = []
+        self.progress = 0.0
+        self.cancelled = False
+        self.stale = False  ## set when its lines left the canvas before it finished
+        self.error = None
+        ## bake samplings are made here, the worker only reads them
+        for line in self.lines:
+            line.baked(Pref.curve_bake_tolerance)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    @property
+    def done(self):
+        return not self.thread.is_alive()
+
+    def _run(self):
+        try:
+            for i, (x,y,w,h) in enumerate(self.rects):
+                if self.cancelled:
+                    return
+                layer = np.zeros((h, w, 4), dtype=np.float32)
+                rasterize_lines(layer, self.lines, self.profile, center=(self.width/2-x, self.height/2-y))
+                self.layers.append(((x,y,w,h), layer))
+                self.progress = (i+1)/len(self.rects)
+        except Exception as e:
+            self.error = e
+
+def finish_bake_job(job):
+    '''
+    merge a finished background bake into its image and drop the baked lines from the canvas.
+    lines drawn while it was running stay. if some of its lines are no longer on the canvas
+    (e.g. the active layer changed), nothing is merged and the remaining lines stay unbaked.
+    @return the image, or None if the job was cancelled, failed or is stale
+    '''
+    if State.job is job:
+        State.job = None
+    if job.cancelled or job.error is not None:
+        return None
+    current = set(map(id, State.lines))
+    if any(id(line) not in current for line in job.lines):
+        job.stale = True
+        return None
+    pixels, _ = begin_bake(job.lines, job.width, job.height, job.imgname, True, job.channel)
+    for (x,y,w,h), layer in job.layers:
+        merge_tile(pixels[y:y+h, x:x+w], layer, job.channel)
+    out = end_bake(job.width, job.height, job.imgname, pixels, job.lines, job.channel)
+    State.lines = [line for line in State.lines if line not in job.lines]
+    if State.img_bake_target is not None:
+        State.img_bake_target = out
+    update_backdrop(out, [r for r,_ in job.layers])
+    return out
+
+class KombTiledMask:
+    '''
+    strokes baked over transparent black (premultiplied) into fixed size tiles, allocated
+    only where they leave coverage. nothing of the frame size is held until `flatten_tiles`
+    merges the tiles into the blender image.
+    '''
+    def __init__(self, imgname, width, height, channel=KombChannel.RGBA, tile_size=None):
+        self.imgname = imgname
+        self.width = width
+        self.height = height
+        self.channel = channel
+        self.tile_size = tile_size or Pref.bake_tile_size
+        self.tiles = {}      ## (tx, ty) -> (h, w, 4) float32
+        self.lines = []      ## baked into the tiles, not into the image yet
+        self.textures = {}   ## (tx, ty) -> GL texture name
+        self.dirty = set()   ## tiles to upload again
+
+    @property
+    def nbytes(self):
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+    def rect(self, key):
+        tx, ty = key
+        x, y = tx*self.tile_size, ty*self.tile_size
+        return x, y, min(self.tile_size, self.width-x), min(self.tile_size, self.height-y)
+
+    def bake(self, lines, profile=KombBrushProfile.HARD):
+        '''
+        @return {tile key: the tile before the bake, None if it was not allocated}
+        '''
+        before = {}
+        for x,y,w,h in dirty_rects(lines, self.width, self.height, self.tile_size):
+            layer = np.zeros((h, w, 4), dtype=np.float32)
+            rasterize_lines(layer, lines, profile, center=(self.width/2-x, self.height/2-y))
+            self.merge_layer(x, y, layer, before)
+        self.lines.extend(lines)
+        return before
+
+    def merge_layer(self, x, y, layer, before=None):
+        '''
+        @param layer -- (h, w, 4) premultiplied, placed at (x, y) in the image
+        @param before -- filled with the tiles before the merge, see `bake`
+        '''
+        ts = self.tile_size
+        before = {} if before is None else before
+        h,w = layer.shape[:2]
+        for ty in range(y//ts, (y+h+ts-1)//ts):
+            for tx in range(x//ts, (x+w+ts-1)//ts):
+                key = (tx, ty)
+                x0,y0,tw,th = self.rect(key)
+                lx0, ly0 = max(x0, x), max(y0, y)
+                lx1, ly1 = min(x0+tw, x+w), min(y0+th, y+h)
+                part = layer[ly0-y:ly1-y, lx0-x:lx1-x]
+                if not part[...,3].any():
+                    continue
+                tile = self.tiles.get(key)
+                if key not in before:
+                    before[key] = None if tile is None else tile.copy()
+                if tile is None:
+                    tile = self.tiles[key] = np.zeros((th, tw, 4), dtype=np.float32)
+                merge_tile(tile[ly0-y0:ly1-y0, lx0-x0:lx1-x0], part)
+                self.dirty.add(key)
+        return before
+
+def bake_lines_to_tiles(lines, width, height, imgname, record=True, profile=KombBrushProfile.HARD
+                        , channel=KombChannel.RGBA):
+    '''
+    bake into `State.tiled` instead of the image, see `KombTiledMask`
+    '''
+    mask = State.tiled
+    if mask is None or (mask.imgname, mask.width, mask.height, mask.channel) != (imgname, width, height, channel):
+        flatten_tiles()
+        mask = State.tiled = KombTiledMask(imgname, width, height, channel)
+    before = mask.bake(lines, profile)
+    if record and lines:
+        get_history().push(KombTilesStep(mask, before, lines))
+    return mask
+
+def flatten_tiles(record=True, keep_pixels=False):
+    '''
+    merge the sparse tiled mask into its image -- on demand, or before anything reading the image.
+    the frame sized pixels needed for the merge are not kept unless they were cached before,
+    or `keep_pixels` is set for a full image change following.
+    @return the image, or None when there was nothing to merge
+    '''
+    mask = State.tiled
+    if mask is None:
+        return None
+    State.tiled = None
+    gl_free_tiles(mask)
+    if not mask.tiles and not mask.lines:
+        return None
+
+    had_pixels = State.pixels is not None
+    pixels = bake_target_pixels(mask.width, mask.height, mask.imgname, mask.channel)
+    if record:
+        img = bpy.data.images.get(mask.imgname)
+        dockey = document_key(mask.channel)
+        before = []
+        for key in mask.tiles:
+            x,y,w,h = r = mask.rect(key)
+            before.append((r, pixels[y:y+h, x:x+w].copy()))
+        get_history().push(KombFlattenStep(mask, before, document_blob(img, dockey), dockey))
+    for key, tile in mask.tiles.items():
+        x,y,w,h = mask.rect(key)
+        merge_tile(pixels[y:y+h, x:x+w], tile, mask.channel)
+    out = end_bake(mask.width, mask.height, mask.imgname, pixels, mask.lines, mask.channel)
+    update_backdrop(out, [mask.rect(key) for key in mask.tiles])
+    if not (had_pixels or keep_pixels):
+        drop_pixels()
+    return out
+
+def drop_pixels():
+    '''
+    free the cached frame pixels -- with sparse tiles, memory follows the painted area
+    '''
+    State.pixels = None
+    State.pixels_key = None
+
+def gl_draw_tiles(mask, center, zoom, scale=(1,1)):
+    '''
+    draw the tiles of a sparse mask over the backdrop, a texture per tile.
+    only the tiles changed since the last draw are uploaded.
+    '''
+    for key in mask.dirty:
+        tex = mask.textures.pop(key, None)
+        if tex is not None:
+            bgl.glDeleteTextures(1, bgl.Buffer(bgl.GL_INT, 1, [tex]))
+        tile = mask.tiles.get(key)
+        if tile is None:
+            continue
+        h,w = tile.shape[:2]
+        if mask.channel != KombChannel.RGBA:
+            ## as merged into the one channel, see `merge_tile`
+            gray = np.empty_like(tile)
+            gray[...,:3] = tile[...,:3].mean(axis=-1, keepdims=True)
+            gray[...,3] = tile[...,3]
+            tile = gray
+        buf = bgl.Buffer(bgl.GL_INT, 1)
+        bgl.glGenTextures(1, buf)
+        mask.textures[key] = buf[0]
+        bgl.glBindTexture(bgl.GL_TEXTURE_2D, buf[0])
+        bgl.glTexParameteri(bgl.GL_TEXTURE_2D, bgl.GL_TEXTURE_MIN_FILTER, bgl.GL_NEAREST)
+        bgl.glTexParameteri(bgl.GL_TEXTURE_2D, bgl.GL_TEXTURE_MAG_FILTER, bgl.GL_NEAREST)
+        bgl.glTexImage2D(bgl.GL_TEXTURE_2D, 0, bgl.GL_RGBA, w, h, 0, bgl.GL_RGBA, bgl.GL_FLOAT
+                         , bgl.Buffer(bgl.GL_FLOAT, [h*w*4], tile.ravel().tolist()))
+    mask.dirty = set()
+
+    bgl.glEnable(bgl.GL_BLEND)
+    bgl.glBlendFunc(bgl.GL_ONE, bgl.GL_ONE_MINUS_SRC_ALPHA)
+    bgl.glEnable(bgl.GL_TEXTURE_2D)
+    bgl.glColor4f(1,1,1,1)
+    sx, sy = scale[0]*zoom, scale[1]*zoom
+    ox, oy = center[0]-mask.width/2*sx, center[1]-mask.height/2*sy
+    for key, tex in mask.textures.items():
+        x,y,w,h = mask.rect(key)
+        bgl.glBindTexture(bgl.GL_TEXTURE_2D, tex)
+        bgl.glBegin(bgl.GL_QUADS)
+        for u,v in ((0,0),(1,0),(1,1),(0,1)):
+            bgl.glTexCoord2f(u,v)
+            bgl.glVertex2f(ox+(x+u*w)*sx, oy+(y+v*h)*sy)
+        bgl.glEnd()
+    bgl.glDisable(bgl.GL_TEXTURE_2D)
+    bgl.glBlendFunc(bgl.GL_SRC_ALPHA, bgl.GL_ONE_MINUS_SRC_ALPHA)
+
+def gl_free_tiles(mask):
+    if mask.textures:
+        bgl.glDeleteTextures(len(mask.textures), bgl.Buffer(bgl.GL_INT, len(mask.textures), list(mask.textures.values())))
+    mask.textures = {}
+    mask.dirty = set(mask.tiles)
+
+def bake_target_pixels(width, height, imgname, channel=KombChannel.RGBA):
+    '''
+    @return float32 array of shape (height, width, 4)
+        -- cached copy of the bake target's pixels (or the image baked last), which
+           the strokes are merged into. only the first bake reads back the blender image.
+    @param channel -- for a single channel the image is read back as is, so the other
+                      packed channels (and alpha) are written back unchanged.
+    '''
+    src = State.img_bake_target
+    if src is None or src.size[0]*src.size[1] == 0:
+        src = bpy.data.images.get(imgname)
+    key = (src.name if src else '', width, height)
+    if State.pixels is None or State.pixels_key not in {key, (imgname, width, height)}:
+        if src is not None and src.size[0]*src.size[1] != 0 and channel != KombChannel.RGBA:
+            pixels = np.array(resample_nearest(image_pixels_get(src), width, height), dtype=np.float32)
+        elif src is not None and src.size[0]*src.size[1] != 0:
+            ## as the backdrop is drawn on the offscreen -- stretched with `GL_NEAREST`, alpha over black
+            pixels = np.zeros((height, width, 4), dtype=np.float32)
+            composite_over(pixels, resample_nearest(image_pixels_get(src), width, height))
+        else:
+            pixels = np.zeros((height, width, 4), dtype=np.float32)
+        State.pixels = pixels
+    State.pixels_key = (imgname, width, height)
+    return State.pixels
+
+def dirty_rects(lines, width, height, tile_size):
+    '''
+    @return [(x, y, w, h), ...]
+        -- image tiles touched by the segments of `lines` (as round capped, soft or hard),
+           merged into horizontal spans per tile row.
+    '''
+    bs = [segment_bounds(baked_curve(line)) for line in lines if len(line.seq) > 1]
+    if not bs or width*height == 0:
+        return []
+    offset = np.array((width/2, height/2), dtype=np.float32)
+    lo = np.floor(np.concatenate([b[0] for b in bs]) + offset).astype(np.int64)
+    hi = np.ceil(np.concatenate([b[1] for b in bs]) + offset).astype(np.int64)
+    visible = (hi[:,0]>=0) & (lo[:,0]<width) & (hi[:,1]>=0) & (lo[:,1]<height)
+    lo, hi = lo[visible], hi[visible]
+
+    ntx = (width+tile_size-1)//tile_size
+    nty = (height+tile_size-1)//tile_size
+    tx0 = (lo[:,0]//tile_size).clip(0,ntx-1)
+    tx1 = (hi[:,0]//tile_size).clip(0,ntx-1)+1
+    ty0 = (lo[:,1]//tile_size).clip(0,nty-1)
+    ty1 = (hi[:,1]//tile_size).clip(0,nty-1)+1
+    tiles = np.zeros((nty, ntx), dtype=bool)
+    _, cx, cy = _grid_cells(tx0, tx1, ty0, ty1)
+    tiles[cy, cx] = True
+
+    rects = []
+    for ty in np.flatnonzero(tiles.any(axis=1)):
+        d = np.diff(np.concatenate(([0], tiles[ty].astype(np.int8), [0])))
+        for a,b in zip(np.flatnonzero(d==1), np.flatnonzero(d==-1)):
+            x, y = int(a)*tile_size, int(ty)*tile_size
+            rects.append((x, y, min(int(b)*tile_size, width)-x, min(y+tile_size, height)-y))
+    return rects
+
+def lines_per_rect(lines, rects, width, height):
+    '''
+    @return [(rect, lines), ...] -- per rect, the lines (in drawing order) whose segments reach into it
+    '''
+    lines = [line for line in lines if len(line.seq) > 1]
+    if not lines:
+        return [(r, []) for r in rects]
+    offset = np.array((width/2, height/2), dtype=np.float32)
+    bs = [segment_bounds(baked_curve(line)) for line in lines]
+    lo = np.array([b[0].min(axis=0) for b in bs]) + offset
+    hi = np.array([b[1].max(axis=0) for b in bs]) + offset
+    out = []
+    for x,y,w,h in rects:
+        hit = (hi[:,0]>=x) & (lo[:,0]<x+w) & (hi[:,1]>=y) & (lo[:,1]<y+h)
+        out.append(((x,y,w,h), [lines[i] for i in np.flatnonzero(hit)]))
+    return out
+
+def segment_bounds(ps):
+    '''
+    @return (lo, hi) -- (n-1, 2) arrays, bounding boxes of the segments of `ps` with their radius
+                        and a pixel of antialiasing around them.
+    '''
+    a, b = ps[:-1], ps[1:]
+    reach = np.maximum(a[:,2:3], b[:,2:3]) + 1
+    return np.minimum(a[:,:2], b[:,:2]) - reach, np.maximum(a[:,:2], b[:,:2]) + reach
+
+def _grid_cells(x0, x1, y0, y1):
+    '''
+    enumerate every cell of many rectangles [x0,x1) x [y0,y1) at once.
+    @return (index, x, y) -- flat arrays, `index` tells which rectangle the cell belongs to
+    '''
+    bw = (x1-x0).clip(0)
+    counts = bw*(y1-y0).clip(0)
+    idx = np.repeat(np.arange(len(counts)), counts)
+    off = np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts, counts)
+    return idx, x0[idx] + off%bw[idx], y0[idx] + off//bw[idx]
+
+def image_pixels_get(img):
+    '''
+    @return float32 array of shape (height, width, 4)
+    '''
+    w,h = img.size[:]
+    return np.array(img.pixels[:], dtype=np.float32).reshape(h, w, 4)
+
+def image_pixels_set(img, pixels):
+    img.pixels = pixels.ravel().tolist()
+
+def resample_nearest(pixels, width, height):
+    '''
+    scale as the GL backdrop quad does with `GL_NEAREST`
+    '''
+    h,w = pixels.shape[:2]
+    if (w,h) == (width,height):
+        return pixels
+    xs = ((np.arange(width)+.5)*w/width).astype(int).clip(0,w-1)
+    ys = ((np.arange(height)+.5)*h/height).astype(int).clip(0,h-1)
+    return pixels[ys[:,None], xs[None,:]]
+
+def composite_over(dst, src):
+    '''
+    `glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)` on all four channels
+    '''
+    a = src[...,3:4]
+    dst *= 1-a
+    dst += src*a
+
+def rasterize_lines(buf, lines, profile=KombBrushProfile.HARD, center=None):
+    '''
+    @param buf -- (height, width, 4) float32 RGBA, drawn in place
+    @param profile -- `HARD` fills the quads as the GL path does, other profiles draw
+                      antialiased strokes fading out towards their radius.
+    @param center -- pixel position of the image center in `buf`, defaults to the center of `buf`
+    '''
+    h,w = buf.shape[:2]
+    cx, cy = center or (w/2, h/2)
+    if profile == KombBrushProfile.HARD:
+        offset = np.array((cx, cy), dtype=np.float32)
+        for color, quads in iter_color_batches(lines, baked_quads):
+            rasterize_quads(buf, quads+offset, (*color, 1.0))
+    else:
+        offset = np.array((cx, cy, 0), dtype=np.float32)
+        for line in lines:
+            if len(line.seq) > 1:
+                rasterize_soft_line(buf, baked_curve(line)+offset, (*line.color[:3], 1.0), profile)
+
+def rasterize_soft_line(buf, ps, color, profile, max_samples=1<<22):
+    '''
+    draw one stroke as a chain of round capped segments with interpolated radius.
+    coverage is looked up from the falloff table by the distance normalized by the radius;
+    where segments overlap, the highest coverage wins, then the line is blended once.
+
+    @param ps -- (n, 3) array of (x, y, radius) in pixel coordinates
+    '''
+    h,w = buf.shape[:2]
+    lo, hi = segment_bounds(ps)
+    x0 = np.ceil(lo[:,0]-.5).astype(np.int64).clip(0,w)
+    x1 = (np.floor(hi[:,0]-.5).astype(np.int64)+1).clip(0,w)
+    y0 = np.ceil(lo[:,1]-.5).astype(np.int64).clip(0,h)
+    y1 = (np.floor(hi[:,1]-.5).astype(np.int64)+1).clip(0,h)
+    counts = (x1-x0).clip(0)*(y1-y0).clip(0)
+    if not counts.sum():
+        return
+    lx0, ly0 = x0[counts>0].min(), y0[counts>0].min()
+    lx1, ly1 = x1[counts>0].max(), y1[counts>0].max()
+    cov = np.zeros((ly1-ly0, lx1-lx0), dtype=np.float32)
+
+    lut, umax = falloff_lut(profile, float(np.median(ps[:,2])))
+    a, b = ps[:-1], ps[1:]
+    i = 0
+    while i < len(a):
+        j = i+1+np.searchsorted(np.cumsum(counts[i+1:]), max_samples-counts[i], side='right')
+        if counts[i:j].sum():
+            si, px, py = _grid_cells(x0[i:j], x1[i:j], y0[i:j], y1[i:j])
+            si += i
+            ab = b[si,:2]-a[si,:2]
+            ap = np.stack((px+.5, py+.5), axis=1) - a[si,:2]
+            ll = (ab*ab).sum(axis=1)
+            t = np.where(ll>0, (ap*ab).sum(axis=1)/np.where(ll>0, ll, 1), 0).clip(0,1)
+            d = np.hypot(*(ap - ab*t[:,None]).T)
+            r = a[si,2] + (b[si,2]-a[si,2])*t
+            u = d/np.maximum(r, 1e-6)
+            c = lut[np.minimum(u/umax*(len(lut)-1), len(lut)-1).astype(np.int64)]
+            np.maximum.at(cov, (py-ly0, px-lx0), c)
+        i = j
+
+    region = buf[ly0:ly1, lx0:lx1]
+    c = cov[...,None]
+    region *= 1-c
+    region += np.array(color, dtype=np.float32)*c
+
+_falloff_luts = {}
+def falloff_lut(profile, radius, size=1024):
+    '''
+    @return (lut, umax) -- coverage for the distance normalized by the radius, u in [0, umax].
+        the brush profile is combined with a one pixel antialiased edge, whose width in `u`
+        depends on the radius. so tables are cached per radius bucket (quarter octaves).
+    '''
+    bucket = round(math.log2(max(radius, .25))*4)
+    key = (profile, bucket)
+    if key not in _falloff_luts:
+        r = 2**(bucket/4)
+        umax = 1+1/r
+        u = np.linspace(0, umax, size)
+        x = (1-u).clip(0,1)
+        if profile == KombBrushProfile.LINEAR:
+            f = x
+        elif profile == KombBrushProfile.SMOOTHSTEP:
+            f = x*x*(3-2*x)
+        elif profile == KombBrushProfile.GAUSSIAN:
+            g1 = math.exp(-4.5)
+            f = ((np.exp(-4.5*u*u)-g1)/(1-g1)).clip(0,1)
+        else:
+            f = np.ones_like(u)
+        edge = ((1-u)*r + .5).clip(0,1)
+        lut = (f*edge).astype(np.float32)
+        lut[-1] = 0
+        _falloff_luts[key] = (lut, umax)
+    return _falloff_luts[key]
+
+def rasterize_quads(buf, quads, color, max_spans=1<<20):
+    '''
+    fill quads (in pixel coordinates) with an opaque color.
+    each quad is split into two triangles like `GL_QUADS`, pixels are sampled at their centers.
+    the triangles are cut into one span per pixel row, and the spans are counted into a per row
+    difference array -- overlapping quads (the segments of a stroke) cost their rows, not their
+    area. the triangles are processed in chunks so that the spans stay under `max_spans`.
+    '''
+    h,w = buf.shape[:2]
+    q = quads.astype(np.float64)
+    tris = np.concatenate((q[:,[0,1,2]], q[:,[0,2,3]]))
+    a, b, c = tris[:,0], tris[:,1], tris[:,2]
+    area = (b[:,0]-a[:,0])*(c[:,1]-a[:,1]) - (b[:,1]-a[:,1])*(c[:,0]-a[:,0])
+    tris = tris[area != 0]
+    r0 = np.ceil(tris[:,:,1].min(axis=1)-.5).clip(0,h).astype(np.int64)
+    r1 = (np.floor(tris[:,:,1].max(axis=1)-.5)+1).clip(0,h).astype(np.int64)
+    counts = (r1-r0).clip(0)
+
+    i = 0
+    while i < len(tris):
+        ## at least one triangle per chunk
+        j = i+1+np.searchsorted(np.cumsum(counts[i+1:]), max_spans-counts[i], side='right')
+        if counts[i:j].sum():
+            ti = np.repeat(np.arange(i, j), counts[i:j])
+            rows = r0[ti] + np.arange(len(ti)) - np.repeat(np.cumsum(counts[i:j])-counts[i:j], counts[i:j])
+            x0, x1 = _triangle_spans(tris[ti], rows+.5, w)
+            ok = x1 > x0
+            if ok.any():
+                rows, x0, x1 = rows[ok], x0[ok], x1[ok]
+                top, n = rows.min(), rows.max()+1-rows.min()
+                stride = w+1
+                base = (rows-top)*stride
+                diff = np.bincount(base+x0, minlength=n*stride) - np.bincount(base+x1, minlength=n*stride)
+                cover = np.cumsum(diff.reshape(n, stride)[:,:w], axis=1) > 0
+                buf[top:top+n][cover] = color
+        i = j
+
+def _triangle_spans(tris, yc, w):
+    '''
+    @return (x0, x1) -- int arrays, the pixels [x0, x1) of row `yc` (pixel center height)
+                        whose centers are inside the triangles, clipped to [0, w)
+    '''
+    xl = np.full(len(yc), np.inf)
+    xr = np.full(len(yc), -np.inf)
+    for a, b in ((0,1), (1,2), (2,0)):
+        ax, ay, bx, by = tris[:,a,0], tris[:,a,1], tris[:,b,0], tris[:,b,1]
+        cross = (np.minimum(ay, by) <= yc) & (yc <= np.maximum(ay, by)) & (ay != by)
+        x = ax + (yc-ay)*(bx-ax)/np.where(cross, by-ay, 1)
+        xl = np.where(cross, np.minimum(xl, x), xl)
+        xr = np.where(cross, np.maximum(xr, x), xr)
+    x0 = np.ceil(xl-.5).clip(0, w).astype(np.int64)
+    x1 = (np.floor(xr-.5)+1).clip(0, w).astype(np.int64)
+    return x0, x1
+
+
+class KombHistory:
+    '''
+    undo/redo stack of steps. each step provides `undo()`, `redo()` and `nbytes`.
+    the oldest steps are dropped when the total size exceeds `budget` bytes.
+    '''
+    def __init__(self, budget):
+        self.budget = budget
+        self._undo = []
+        self._redo = []
+
+    @property
+    def nbytes(self):
+        return sum(step.nbytes for step in self._undo+self._redo)
+
+    def push(self, step):
+        self._redo = []
+        if step.nbytes > self.budget:
+            ## can't be undone, so neither can anything before it
+            self._undo = []
+            return
+        self._undo.append(step)
+        while self.nbytes > self.budget:
+            self._undo.pop(0)
+
+    def undo(self):
+        if not self._undo:
+            return False
+        step = self._undo.pop()
+        step.undo()
+        self._redo.append(step)
+        return True
+
+    def redo(self):
+        if not self._redo:
+            return False
+        step = self._redo.pop()
+        step.redo()
+        self._undo.append(step)
+        return True
+
+class KombAddLineStep:
+    def __init__(self, line, frame=None):
+        self.line = line
+        self.frame = frame ## layer key, when drawn on animated layers
+        self.nbytes = line.seq.array().nbytes + line.tessellation().nbytes
+    def _lines(self):
+        return State.layers.setdefault(self.frame, []) if self.frame is not None else State.lines
+    def undo(self):
+        lines = self._lines()
+        if self.line in lines:
+            lines.remove(self.line)
+    def redo(self):
+        self._lines().append(self.line)
+
+class KombPixelsStep:
+    '''
+    pixel regions of an image before a change (bake, clear), and the lines that were baked.
+    undo and redo both swap the stored regions with the image's current ones,
+    so nothing is re-rasterized.
+    '''
+    def __init__(self, imgname, tiles, lines=(), document=None, document_key=None):
+        self.imgname = imgname
+        self.tiles = tiles
+        self.lines = list(lines)
+        self.document = document
+        self.document_key = document_key or Pref.document_key
+        self.nbytes = sum(tile.nbytes for _,tile in tiles) + len(document or b'')
+
+    def _swap(self):
+        img = bpy.data.images.get(self.imgname)
+        if img is None:
+            return
+        w,h = img.size[:]
+        if State.pixels is None or State.pixels_key != (self.imgname, w, h):
+            State.pixels = image_pixels_get(img).copy()
+            State.pixels_key = (self.imgname, w, h)
+        pixels = State.pixels
+        tiles = []
+        for (x,y,tw,th), tile in self.tiles:
+            if x+tw > w or y+th > h:
+                continue
+            tiles.append(((x,y,tw,th), pixels[y:y+th, x:x+tw].copy()))
+            pixels[y:y+th, x:x+tw] = tile
+        self.tiles = tiles
+        image_pixels_set(img, pixels)
+        update_backdrop(img, [r for r,_ in tiles])
+
+        document = document_blob(img, self.document_key)
+        if self.document is not None:
+            img[self.document_key] = self.document
+        elif self.document_key in img:
+            del img[self.document_key]
+        self.document = document
+
+    def undo(self):
+        self._swap()
+        State.lines[:0] = [line for line in self.lines if line not in State.lines]
+
+    def redo(self):
+        self._swap()
+        for line in self.lines:
+            if line in State.lines:
+                State.lines.remove(line)
+
+class KombTilesStep:
+    '''
+    tiles of a sparse mask before a bake into it
+    '''
+    def __init__(self, mask, tiles, lines):
+        self.mask = mask
+        self.tiles = tiles  ## {key: tile or None}
+        self.lines = list(lines)
+        self.nbytes = sum(tile.nbytes for tile in tiles.values() if tile is not None)
+
+    def _swap(self):
+        tiles = {}
+        for key, tile in self.tiles.items():
+            tiles[key] = self.mask.tiles.pop(key, None)
+            if tile is not None:
+                self.mask.tiles[key] = tile
+            self.mask.dirty.add(key)
+        self.tiles = tiles
+
+    def undo(self):
+        self._swap()
+        self.mask.lines = [line for line in self.mask.lines if line not in self.lines]
+        State.lines[:0] = [line for line in self.lines if line not in State.lines]
+
+    def redo(self):
+        self._swap()
+        self.mask.lines.extend(self.lines)
+        for line in self.lines:
+            if line in State.lines:
+                State.lines.remove(line)
+
+class KombFlattenStep(KombPixelsStep):
+    '''
+    image regions before a sparse mask was merged in. undo brings the mask back
+    '''
+    def __init__(self, mask, tiles, document=None, document_key=None):
+        super().__init__(mask.imgname, tiles, (), document, document_key)
+        self.mask = mask
+
+    def _swap(self):
+        had_pixels = State.pixels is not None
+        super()._swap()
+        if not had_pixels:
+            drop_pixels()
+
+    def undo(self):
+        self._swap()
+        State.tiled = self.mask
+
+    def redo(self):
+        self._swap()
+        if State.tiled is self.mask:
+            gl_free_tiles(self.mask)
+            State.tiled = None
+
+def lines_to_blob(lines, width, height):
+    '''
+    @return bytes -- float32 array of
+        [version, width, height, number of lines,
+         (r, g, b, number of points, x0, y0, radius0, x1, ...) for each line]
+    '''
+    return blob_header(width, height, len(lines)) + lines_to_blob_body(lines)
+
+def blob_header(width, height, count):
+    return np.array((1, width, height, count), dtype=np.float32).tobytes()
+
+def lines_to_blob_body(lines, scale=None):
+    '''
+    @return bytes -- the lines' part of `lines_to_blob`, points multiplied by `scale` (x, y, radius)
+    '''
+    parts = [np.empty(0, dtype=np.float32)]
+    for line in lines:
+        ps = line.seq.array() if scale is None else line.seq.array()*scale
+        parts.append(np.array((*line.color[:3], len(ps)), dtype=np.float32))
+        parts.append(ps.ravel())
+    return np.concatenate(parts).tobytes()
+
+def lines_from_blob(blob, width, height):
+    '''
+    @return [KombLine, ...] -- fitted to an image of (width, height)
+    '''
+    a = np.frombuffer(blob, dtype=np.float32)
+    if len(a) < 4 or a[0] != 1:
+        return []
+    _, rw, rh, count = a[:4]
+    scale = np.array((width/rw, height/rh, math.sqrt(width*height/(rw*rh))), dtype=np.float32)
+    lines = []
+    i = 4
+    for _ in range(int(count)):
+        r, g, b, n = a[i:i+4]
+        n = int(n)
+        line = KombLine((float(r), float(g), float(b)))
+        line.seq.extend(a[i+4:i+4+n*3].reshape(n,3)*scale)
+        lines.append(line)
+        i += 4+n*3
+    return lines
+
+def document_blob(img, key=None):
+    key = key or Pref.document_key
+    if img is None or key not in img:
+        return None
+    return bytes(img[key])
+
+def document_load(img, key, width, height):
+    blob = document_blob(img, key)
+    return lines_from_blob(blob, width, height) if blob else []
+
+def document_save(img, key, lines, width, height):
+    img[key] = lines_to_blob(lines, width, height)
+
+def document_append(img, key, lines, width, height):
+    '''
+    add `lines` (fitted to width x height) after the stored strokes -- only the header is
+    written again, the stored strokes are copied as bytes, not parsed.
+    '''
+    blob = document_blob(img, key)
+    head = np.frombuffer(blob[:16], dtype=np.float32) if blob and len(blob) >= 16 else None
+    if head is None or head[0] != 1:
+        document_save(img, key, lines, width, height)
+        return
+    _, rw, rh, count = head.tolist()
+    scale = None
+    if (rw, rh) != (width, height):
+        scale = np.array((rw/width, rh/height, math.sqrt(rw*rh/(width*height))), dtype=np.float32)
+    img[key] = b''.join((blob_header(rw, rh, int(count)+len(lines)), memoryview(blob)[16:]
+                        , lines_to_blob_body(lines, scale)))
+
+def document_key(channel=KombChannel.RGBA):
+    '''
+    strokes of each packed channel are kept apart
+    '''
+    return Pref.document_key if channel == KombChannel.RGBA else '{}_{}'.format(Pref.document_key, channel)
+
+def layers_load(img, width, height):
+    if img is None or Pref.layers_key not in img:
+        return {}
+    return {int(frame): lines_from_blob(bytes(blob), width, height)
+            for frame, blob in img[Pref.layers_key].items()}
+
+def layers_save(img, layers, width, height):
+    if layers:
+        img[Pref.layers_key] = {str(frame): lines_to_blob(lines, width, height)
+                                for frame, lines in layers.items()}
+    elif Pref.layers_key in img:
+        del img[Pref.layers_key]
+
+def finish_stroke(layer_key=None):
+    '''
+    end the stroke being drawn: the samples held by the stroke filter go into the line, which
+    is then recorded for undo, or dropped when it has less than 2 points.
+    @param layer_key -- key frame of the layer the stroke is drawn on, with animated layers
+    '''
+    line = State.current_line
+    State.current_line = None
+    if line is None:
+        return
+    for x,y,r in State.stroke_filter.flush():
+        line.seq.add(x, y, r)
+    State.stroke_filter = None
+    if len(line.seq) < 2:
+        if line in State.lines:
+            State.lines.remove(line)
+    else:
+        get_history().push(KombAddLineStep(line, layer_key))
+
+def layer_key_at(frame):
+    '''
+    @return the key frame whose strokes are held on `frame`, or None before the first key.
+    '''
+    keys = sorted(State.layers)
+    i = bisect.bisect_right(keys, frame)
+    return keys[i-1] if i else None
+
+def activate_layer(frame):
+    if State.current_line is not None:
+        ## a stroke across a frame change (e.g. while playing) ends in the layer it was drawn on
+        finish_stroke(next((key for key, lines in State.layers.items() if lines is State.lines), None))
+    key = layer_key_at(frame)
+    State.lines = State.layers[key] if key is not None else []
+
+def ensure_layer_key(frame):
+    '''
+    make `frame` a key, starting from the strokes held there.
+    '''
+    if frame not in State.layers:
+        key = layer_key_at(frame)
+        State.layers[frame] = list(State.layers[key]) if key is not None else []
+    State.lines = State.layers[frame]
+
+def on_frame_change(scene):
+    State.viewer_pixels = None
+    if State.enabled and get_use_layers(bpy.context):
+        activate_layer(scene.frame_current)
+
+def layers_toggled(self, context):
+    if not State.enabled:
+        return
+    if self.komb_use_layers:
+        if not State.layers and State.lines:
+            State.layers[context.scene.frame_current] = State.lines
+        activate_layer(context.scene.frame_current)
+    context.area.tag_redraw()
+
+def bake_sequence(layers, width, height, frame_start, frame_end, path, profile=KombBrushProfile.HARD):
+    '''
+    bake animated stroke layers into an image sequence "<path>####.png".
+    only frames where the held layer changes are rasterized, the other frames are
+    linked (or copied) from the previous file. lines cache their tessellation,
+    so layers sharing lines share that work too.
+
+    @return (number of rasterized frames, number of linked frames)
+    '''
+    keys = sorted(layers)
+    dirpath = os.path.dirname(path)
+    if dirpath:
+        os.makedirs(dirpath, exist_ok=True)
+    scratch = prepare_blimage(width, height, Pref.sequence_scratch_image_name)
+    scratch.file_format = 'PNG'
+
+    written, linked = 0, 0
+    prev_key, prev_file = object(), None
     try:
-        bgl.glMatrixMode(bgl.GL_PROJECTION)
-        bgl.glLoadIdentity()
-        bgl.glScalef(1/width*2,1/height*2,1.0)
-        bgl.glTranslatef(-width/2,-height/2,0)
-
-        draw_callback(self, context, {
-                  'center': Vector((width/2, height/2))
-                , 'zoom': 1.0
-                , 'back_image_alpha': 1.0
-                , 'image_size': (width, height)
-                })
-
-        buffer = bgl.Buffer(bgl.GL_FLOAT, width * height * 4)
-        x,y = 0,0
-        bgl.glReadPixels(x, y, width, height , bgl.GL_RGBA, bgl.GL_FLOAT, buffer)
-
-        out = prepare_blimage(width, height, imgname or Pref.default_output_image_name)
-        out.pixels = buffer[:]
+        for frame in range(frame_start, frame_end+1):
+            i = bisect.bisect_right(keys, frame)
+            key = keys[i-1] if i else None
+            filepath = '{}{:04d}.png'.format(path, frame)
+            if key == prev_key and prev_file:
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+                try:
+                    os.link(prev_file, filepath)
+                except OSError:
+                    shutil.copyfile(prev_file, filepath)
+                linked += 1
+                continue
+            buf = np.zeros((height, width, 4), dtype=np.float32)
+            buf[...,3] = 1
+            if key is not None:
+                rasterize_lines(buf, layers[key], profile)
+            image_pixels_set(scratch, buf)
+            scratch.filepath_raw = filepath
+            scratch.save()
+            written += 1
+            prev_key, prev_file = key, filepath
     finally:
-        gos.unbind(True)
-
+        remove_image(scratch)
+    return written, linked
+
+def get_viewer_pixels():
+    '''
+    @return (planes, scale) -- RGB of the Viewer Node as (3, height, width) uint16 with
+                               value = color*scale, or None. read once per frame.
+    '''
+    img = get_viewer_image()
+    if img is None:
+        return None
+    w,h = img.size[:]
+    if State.viewer_pixels is None or State.viewer_pixels[0].shape[1:] != (h, w):
+        rgb = image_pixels_get(img)[...,:3].transpose(2,0,1)
+        ## 16 bit planes: a quarter of the memory traffic of float RGBA, and HDR values are kept
+        scale = 65535/max(1.0, float(rgb.max()))
+        State.viewer_pixels = ((rgb.clip(0, None)*scale + .5).astype(np.uint16), scale)
+    return State.viewer_pixels
+
+def fill_at(context, x, y):
+    '''
+    fill tool: select by the Viewer Node's color at (x, y), merge the selection into the bake
+    target (or its sparse tiles) with the brush color.
+    @return the changed rect (x, y, w, h), or None
+    '''
+    viewer = get_viewer_pixels()
+    img = get_bake_target(context)
+    if viewer is None or img is None:
+        return None
+    planes, scale = viewer
+    h,w = planes.shape[1:]
+    if not (0 <= x < w and 0 <= y < h):
+        return None
+    wm = context.window_manager
+    region = color_region(planes, x, y, int(wm.komb_fill_tolerance*scale), wm.komb_fill_contiguous)
+    rows = np.flatnonzero(region.any(axis=1))
+    cols = np.flatnonzero(region.any(axis=0))
+    rx, ry = int(cols[0]), int(rows[0])
+    rw, rh = int(cols[-1])+1-rx, int(rows[-1])+1-ry
+    color = (*get_brush_color(context)[:3], 1.0)
+
+    channel = get_bake_channel(context)
+    rect = (rx, ry, rw, rh)
+    if get_use_sparse_tiles(context):
+        mask = bake_lines_to_tiles([], w, h, img.name, False, channel=channel)
+        ## a layer per tile -- a plate sized selection makes no plate sized float layer
+        ts = mask.tile_size
+        before = {}
+        for ty in range(ry//ts, (ry+rh+ts-1)//ts):
+            for tx in range(rx//ts, (rx+rw+ts-1)//ts):
+                x0,y0,tw,th = mask.rect((tx, ty))
+                part = region[y0:y0+th, x0:x0+tw]
+                if part.any():
+                    layer = np.zeros((th, tw, 4), dtype=np.float32)
+                    layer[part] = color
+                    mask.merge_layer(x0, y0, layer, before)
+        get_history().push(KombTilesStep(mask, before, ()))
+        return rect
+    layer = np.zeros((rh, rw, 4), dtype=np.float32)
+    layer[region[ry:ry+rh, rx:rx+rw]] = color
+    flatten_tiles(keep_pixels=True)
+    pixels = bake_target_pixels(w, h, img.name, channel)
+    dst = pixels[ry:ry+rh, rx:rx+rw]
+    get_history().push(KombPixelsStep(img.name, [(rect, dst.copy())]))
+    merge_tile(dst, layer, channel)
+    out = end_bake(w, h, img.name, pixels)
+    State.img_bake_target = out
+    update_backdrop(out, [rect])
+    return rect
+
+def color_region(planes, x, y, tolerance, contiguous=True):
+    '''
+    @param planes -- (3, h, w) uint16, see `get_viewer_pixels`
+    @return (h, w) bool -- pixels within `tolerance` (per component, in plane units) of the color
+                           at (x, y), with `contiguous` only those 4-connected to it
+    '''
+    region = np.ones(planes.shape[1:], dtype=bool)
+    d = np.empty(planes.shape[1:], dtype=np.uint16)
+    inside = np.empty(planes.shape[1:], dtype=bool)
+    for plane in planes:
+        v = int(plane[y, x])
+        lo, hi = max(0, v-tolerance), min(65535, v+tolerance)
+        ## lo <= p <= hi as one unsigned compare: below `lo` wraps around to large values
+        np.subtract(plane, np.uint16(lo), out=d)
+        np.less_equal(d, np.uint16(hi-lo), out=inside)
+        region &= inside
+    return connected_region(region, x, y) if contiguous else region
+
+def connected_region(mask, x, y):
+    '''
+    the 4-connected part of `mask` holding (x, y). the horizontal runs of all rows are found at
+    once and linked to the overlapping runs of the next row, then labeled by union-find in
+    whole-array passes: hook the larger root of every unsettled link to the smaller, flatten.
+    '''
+    h,w = mask.shape
+    out = np.zeros_like(mask)
+    if not mask[y, x]:
+        return out
+    ## runs [x0, x1) as flat keys row*stride+x -- every row starts and ends outside a run
+    stride = w+1
+    padded = np.zeros((h, w+2), dtype=bool)
+    padded[:,1:-1] = mask
+    changes = np.flatnonzero(padded[:,1:] != padded[:,:-1])
+    k0, k1 = changes[0::2], changes[1::2]
+
+    ## links: the runs of the next row overlapping [x0, x1) are [i, j)
+    i = sorted_rank(k1, k0+stride, side='right')
+    j = sorted_rank(k0, k1+stride, side='left')
+    counts = (j-i).clip(0)
+    a = np.repeat(np.arange(len(k0)), counts)
+    b = np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts-i, counts)
+
+    parent = np.arange(len(k0))
+    while len(a):
+        pa, pb = parent[a], parent[b]
+        unsettled = pa != pb
+        if not unsettled.any():
+            break
+        a, b, pa, pb = a[unsettled], b[unsettled], pa[unsettled], pb[unsettled]
+        parent[np.maximum(pa, pb)] = np.minimum(pa, pb)
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+
+    seed = np.searchsorted(k1, y*stride+x, side='right')
+    selected = parent == parent[seed]
+    ## paint the smaller side: the selected runs, or the others cleared from `mask`
+    lengths = k1-k0
+    if lengths[selected].sum()*2 <= lengths.sum():
+        runs, value = np.flatnonzero(selected), True
+    else:
+        out[...] = mask
+        runs, value = np.flatnonzero(~selected), False
+    starts = k0[runs] - k0[runs]//stride   ## row*stride+x -> row*w+x
+    n = lengths[runs]
+    out.ravel()[np.arange(n.sum()) + np.repeat(starts-np.cumsum(n)+n, n)] = value
+    return out
+
+def sorted_rank(keys, needles, side='left'):
+    '''
+    `np.searchsorted(keys, needles, side)` for sorted `needles` too: one stable merge
+    of both instead of a binary search per needle.
+    '''
+    if side == 'right':
+        order = np.argsort(np.concatenate((keys, needles)), kind='mergesort')
+        return np.flatnonzero(order >= len(keys)) - np.arange(len(needles))
+    order = np.argsort(np.concatenate((needles, keys)), kind='mergesort')
+    return np.flatnonzero(order < len(needles)) - np.arange(len(needles))
+
+def export_mask(lines, width, height, name, profile=KombBrushProfile.HARD):
+    '''
+    strokes into a Blender Mask datablock, evaluated by the Mask node at any resolution.
+    each stroke, simplified first, becomes a cyclic spline around it. soft profiles keep
+    the inner half of the radius solid and feather out over the rest, per point.
+    consecutive lines of a color go to one layer, added when bright, subtracted when dark.
+
+    @return the mask -- replaced if it exists
+    '''
+    mask = bpy.data.masks.get(name) or bpy.data.masks.new(name)
+    while len(mask.layers):
+        mask.layers.remove(mask.layers[0])
+    size = max(width, height)  ## mask space spans the longer side of the frame by 0..1
+    inset = 0.0 if profile == KombBrushProfile.HARD else .5
+
+    layer, color = None, None
+    for line in lines:
+        ps = simplify_points(baked_curve(line), Pref.mask_simplify_tolerance)
+        if len(ps) < 2:
+            continue
+        c = tuple(line.color[:3])
+        if layer is None or c != color:
+            layer = mask.layers.new('{} {}'.format(name, len(mask.layers)))
+            layer.blend = 'MERGE_ADD' if sum(c)/3 >= .5 else 'MERGE_SUBTRACT'
+            layer.use_fill_overlap = True  ## outlines of sharp turns cross themselves
+            color = c
+        outline, radii = stroke_outline(ps, inset)
+        spline = layer.splines.new()
+        spline.use_cyclic = True
+        spline.points.add(len(outline)-len(spline.points))
+        for point, (x,y), r in zip(spline.points, outline.tolist(), radii.tolist()):
+            point.co = (.5+x/size, .5+y/size)
+            point.handle_type = 'AUTO'
+            point.weight = r*inset/size ## feather width
+    return mask
+
+def simplify_points(ps, tolerance):
+    '''
+    Ramer-Douglas-Peucker over (x, y, radius): points within `tolerance` of the chord between
+    the kept ones, in position and in radius, are dropped.
+    '''
+    n = len(ps)
+    if n < 3:
+        return ps
+    keep = np.zeros(n, dtype=bool)
+    keep[[0,-1]] = True
+    stack = [(0, n-1)]
+    while stack:
+        i, j = stack.pop()
+        if j-i < 2:
+            continue
+        a, b, q = ps[i], ps[j], ps[i+1:j]
+        ab = b[:2]-a[:2]
+        ll = float(ab@ab)
+        t = ((q[:,:2]-a[:2])@ab/ll).clip(0,1) if ll > 0 else np.zeros(len(q), dtype=np.float32)
+        c = a + (b-a)*t[:,None]
+        d = np.maximum(np.hypot(*(q[:,:2]-c[:,:2]).T), np.abs(q[:,2]-c[:,2]))
+        k = int(np.argmax(d))
+        if d[k] > tolerance:
+            m = i+1+k
+            keep[m] = True
+            stack += [(i,m), (m,j)]
+    return ps[keep]
+
+def stroke_outline(ps, inset=0.0):
+    '''
+    @param ps -- (n, 3) array of (x, y, radius), n >= 2
+    @param inset -- fraction of the radius left out of the outline
+    @return (outline, radii) -- (2n+2, 2) closed polygon at `radius*(1-inset)` from the stroke:
+                                down one side, round the end, back along the other side and
+                                round the start. `radii` is the radius of the source point of each.
+    '''
+    p = ps[:,:2]
+    r = ps[:,2]
+    t = p[1:] - p[:-1]
+    l = np.hypot(t[:,0], t[:,1])[:,None]
+    t = np.where(l>0, t/np.where(l>0, l, 1), 0)
+    ## vertex tangents: mean of the adjacent segments
+    vt = np.concatenate((t[:1], t[:-1]+t[1:], t[-1:]))
+    l = np.hypot(vt[:,0], vt[:,1])[:,None]
+    vt = np.where(l>0, vt/np.where(l>0, l, 1), 0)
+    n = np.stack((vt[:,1], -vt[:,0]), axis=1)
+    w = (r*(1-inset))[:,None]
+
+    outline = np.concatenate((p+n*w, p[-1:]+vt[-1:]*w[-1:], (p-n*w)[::-1], p[:1]-vt[:1]*w[:1]))
+    radii = np.concatenate((r, r[-1:], r[::-1], r[:1]))
+    return outline, radii
+
+def distance_to_mask(mask, reach):
+    '''
+    Euclidean distance from every pixel to the nearest True pixel of `mask`, in two separable passes:
+    an exact 1D distance along columns, then a minimum over the horizontal offsets within `reach`.
+    distances up to `reach` are exact, farther ones are only known to be > `reach`.
+    '''
+    h,w = mask.shape
+    far = reach+1
+    idx = np.arange(h)[:,None]
+    last = np.maximum.accumulate(np.where(mask, idx, -far-h), axis=0)
+    nxt = np.minimum.accumulate(np.where(mask, idx, far+2*h)[::-1], axis=0)[::-1]
+    g2 = (np.minimum(idx-last, nxt-idx).clip(0, far).astype(np.float32))**2
+
+    d2 = g2.copy()
+    for k in range(1, int(reach)+1):
+        k2 = np.float32(k*k)
+        np.minimum(d2[:,k:], g2[:,:-k]+k2, out=d2[:,k:])
+        np.minimum(d2[:,:-k], g2[:,k:]+k2, out=d2[:,:-k])
+    return np.sqrt(d2)
+
+def grow_shrink_feather(mask, offset, feather):
+    '''
+    @param mask -- bool array
+    @param offset -- pixels to grow (positive) or shrink (negative) the mask's edge
+    @param feather -- width of the linear ramp across the new edge, in pixels
+    @return float32 array -- coverage in [0, 1]
+    '''
+    reach = int(math.ceil(abs(offset) + feather/2 + 1))
+    ## signed distance to the edge, which lies half a pixel off the boundary pixels. positive inside
+    sd = np.where(mask, distance_to_mask(~mask, reach)-.5, .5-distance_to_mask(mask, reach))
+    sd += offset
+    if feather > 0:
+        return (sd/feather + .5).clip(0,1).astype(np.float32)
+    return (sd >= 0).astype(np.float32)
+
+def update_backdrop(img, rects=None):
+    '''
+    call after the pixels of the bake target changed
+    @param rects -- [(x, y, w, h), ...] the changed regions, None for the whole image.
+                    their contents are copied from the cached pixels now and patched
+                    into the texture on the next draw.
+    '''
+    key = (img.name, *img.size[:])
+    if rects is None or State.backdrop_key != key or State.pixels is None or State.pixels_key != key:
+        State.backdrop_key = None
+        State.backdrop_rects = []
+    else:
+        pixels = State.pixels
+        State.backdrop_rects.extend(((x,y,w,h), pixels[y:y+h, x:x+w].copy()) for x,y,w,h in rects)
+
+def backdrop_texture(context):
+    '''
+    @return (texture, channel) -- GL texture name of the image drawn under the strokes (0 if none),
+        and the packed channel to show alone as gray, or None. the texture is blender's own
+        (`Image.gl_load`); after a bake only the changed rects are patched into it.
+    '''
+    img = State.img_bake_target
+    if img is None or img.size[0]*img.size[1] == 0:
+        return 0, None
+    key = (img.name, *img.size[:])
+    if State.backdrop_key != key:
+        ## <!> `gl_load` keeps a loaded texture, which is stale once `Image.pixels` was set
+        img.gl_free()
+        State.backdrop_rects = []
+    if not img.bindcode[0]:
+        img.gl_load(0, bgl.GL_NEAREST, bgl.GL_NEAREST)
+        State.backdrop_key = key if img.bindcode[0] else None
+    else:
+        img.gl_touch(0)
+    if State.backdrop_rects and img.bindcode[0]:
+        bgl.glBindTexture(bgl.GL_TEXTURE_2D, img.bindcode[0])
+        for (x,y,w,h), data in State.backdrop_rects:
+            bgl.glTexSubImage2D(bgl.GL_TEXTURE_2D, 0, x, y, w, h, bgl.GL_RGBA, bgl.GL_FLOAT
+                                , bgl.Buffer(bgl.GL_FLOAT, [data.size], data.ravel().tolist()))
+    State.backdrop_rects = []
+    channel = get_bake_channel(context)
+    return img.bindcode[0], (None if channel == KombChannel.RGBA else channel)
+
+def gl_texture_swizzle(channel=None):
+    '''
+    show one channel of the bound texture as opaque gray, or its RGBA again with None.
+    without texture swizzles (GL < 3.3) the packed image is shown as it is.
+    '''
+    if not hasattr(bgl, 'GL_TEXTURE_SWIZZLE_R'):
+        return
+    rgba = (bgl.GL_RED, bgl.GL_GREEN, bgl.GL_BLUE, bgl.GL_ALPHA)
+    if channel is not None:
+        c = rgba[channel_index[channel]]
+        rgba = (c, c, c, bgl.GL_ONE)
+    for name, value in zip((bgl.GL_TEXTURE_SWIZZLE_R, bgl.GL_TEXTURE_SWIZZLE_G
+                           , bgl.GL_TEXTURE_SWIZZLE_B, bgl.GL_TEXTURE_SWIZZLE_A), rgba):
+        bgl.glTexParameteri(bgl.GL_TEXTURE_2D, name, value)
+
+def get_history():
+    if State.history is None:
+        State.history = KombHistory(Pref.undo_memory_budget)
+    return State.history
 
 
 def prepare_blimage(width, height, name='output'):
@@ -471,7 +2505,44 @@ def prepare_blimage(width, height, name='output'):
 
 def register():
     bpy.types.WindowManager.komb_bake_target = bpy.props.PointerProperty(type=bpy.types.Image)
+    bpy.types.WindowManager.komb_bake_engine = bpy.props.EnumProperty(name='Bake Engine'
+                                            , items=[(KombBakeEngine.GL, 'OpenGL', 'render with an offscreen buffer')
+                                                    ,(KombBakeEngine.SOFTWARE, 'Software', 'rasterize on CPU, no GL context needed')]
+                                            , default=KombBakeEngine.GL)
+    bpy.types.WindowManager.komb_post_offset = bpy.props.FloatProperty(name='Grow/Shrink', default=0.0, soft_min=-50.0, soft_max=50.0
+                                            , description='pixels to grow (positive) or shrink (negative) the baked mask')
+    bpy.types.WindowManager.komb_post_feather = bpy.props.FloatProperty(name='Feather', default=0.0, min=0.0, soft_max=100.0
+                                            , description='width of the soft edge in pixels')
+    bpy.types.WindowManager.komb_use_layers = bpy.props.BoolProperty(name='Animated Layers', default=False, update=layers_toggled
+                                            , description='keep strokes per key frame, held until the next key')
+    bpy.types.WindowManager.komb_sequence_path = bpy.props.StringProperty(name='Sequence Path', default='//komb/mask_', subtype='FILE_PATH')
+    bpy.types.WindowManager.komb_bake_channel = bpy.props.EnumProperty(name='Bake Channel'
+                                            , items=[(KombChannel.RGBA, 'RGBA', 'one mask in the whole image')]
+                                                   +[(c, c, 'a mask packed in the {} channel'.format(c))
+                                                     for c in (KombChannel.R, KombChannel.G, KombChannel.B, KombChannel.A)]
+                                            , default=KombChannel.RGBA)
+    bpy.types.WindowManager.komb_sparse_tiles = bpy.props.BoolProperty(name='Sparse Tiles', default=False
+                                            , description='bake into tiles allocated only where strokes are, merged into the image on Flatten or Exit')
+    bpy.types.WindowManager.komb_bake_background = bpy.props.BoolProperty(name='Bake in Background', default=False
+                                            , description='rasterize on CPU in a worker thread, keep drawing meanwhile. Esc cancels')
+    bpy.types.WindowManager.komb_multires_scales = bpy.props.StringProperty(name='Multi-Res Scales', default='1 0.5 0.25'
+                                            , description='scale factors of the Viewer Node size, an image is baked for each')
+    bpy.types.WindowManager.komb_tool = bpy.props.EnumProperty(name='Tool'
+                                            , items=[(KombTool.DRAW, 'Draw', 'Ctrl+drag draws strokes')
+                                                    ,(KombTool.FILL, 'Fill', 'Ctrl+click fills by the Viewer Node colors')]
+                                            , default=KombTool.DRAW)
+    bpy.types.WindowManager.komb_fill_tolerance = bpy.props.FloatProperty(name='Fill Tolerance', default=.1, min=0.0, soft_max=1.0
+                                            , description='largest RGB difference from the clicked color')
+    bpy.types.WindowManager.komb_fill_contiguous = bpy.props.BoolProperty(name='Contiguous', default=True
+                                            , description='only the region connected to the clicked pixel, else the color range over the image')
     bpy.types.WindowManager.komb_brush_radius = bpy.props.FloatProperty(default=20.0, min=1.0, soft_max=200.0, step=100)
+    bpy.types.WindowManager.komb_brush_profile = bpy.props.EnumProperty(name='Brush Profile'
+                                            , items=[(KombBrushProfile.HARD, 'Hard', 'hard edge, same as the preview')
+                                                    ,(KombBrushProfile.LINEAR, 'Linear', 'antialiased, linear falloff')
+                                                    ,(KombBrushProfile.SMOOTHSTEP, 'Smooth', 'antialiased, smoothstep falloff')
+                                                    ,(KombBrushProfile.GAUSSIAN, 'Gaussian', 'antialiased, gaussian falloff')]
+                                            , default=KombBrushProfile.HARD
+                                            , description='falloff applied when baking (soft profiles always bake in software)')
     bpy.types.WindowManager.komb_brush_color = bpy.props.FloatVectorProperty(name='Brush Color'
                                             , subtype='COLOR', default=[1.0,1.0,1.0])
     bpy.types.WindowManager.komb_brush_color2 = bpy.props.FloatVectorProperty(name='Brush Color 2'
@@ -483,7 +2554,20 @@ def register():
 
 def unregister():
     del bpy.types.WindowManager.komb_bake_target
+    del bpy.types.WindowManager.komb_bake_engine
+    del bpy.types.WindowManager.komb_multires_scales
+    del bpy.types.WindowManager.komb_bake_channel
+    del bpy.types.WindowManager.komb_sparse_tiles
+    del bpy.types.WindowManager.komb_bake_background
+    del bpy.types.WindowManager.komb_use_layers
+    del bpy.types.WindowManager.komb_post_offset
+    del bpy.types.WindowManager.komb_post_feather
+    del bpy.types.WindowManager.komb_sequence_path
+    del bpy.types.WindowManager.komb_tool
+    del bpy.types.WindowManager.komb_fill_tolerance
+    del bpy.types.WindowManager.komb_fill_contiguous
     del bpy.types.WindowManager.komb_brush_radius
+    del bpy.types.WindowManager.komb_brush_profile
     del bpy.types.WindowManager.komb_brush_color
     del bpy.types.WindowManager.komb_brush_color2
     bpy.utils.unregister_class(Komb_Operator)
@@ -0,0 +1,319 @@
+'''
+Komb benchmark -- draw, bake and memory with synthetic strokes.
+
+runs headless: `bgl` and `gpu` are always replaced by recording no-ops, so the timings are
+the Python/NumPy side of drawing and baking (GL readback returns black).
+`bpy` and `mathutils` are stubbed only when not available, so both work:
+
+    python komb_bench.py [--quick] [-o result.json]
+    blender -b --python komb_bench.py -- [--quick] [-o result.json]
+
+the result is JSON -- compare two runs to find regressions between versions.
+'''
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import types
+
+import numpy as np
+
+
+POINTS = [10, 1000, 100000, 1000000]
+SIZES = [(512, 512), (1920, 1080), (3840, 2160), (7680, 4320)]
+QUICK_POINTS = [10, 1000, 100000]
+QUICK_SIZES = [(512, 512), (1920, 1080)]
+POINTS_PER_LINE = 1000
+MULTIRES_SCALES = [1.0, 0.5, 0.25]
+
+
+class _StubGL(types.ModuleType):
+    '''
+    `bgl` doing nothing but counting the calls. `Buffer` is backed by a NumPy array.
+    '''
+    class Buffer:
+        def __init__(self, type, dimensions, template=None):
+            n = dimensions if isinstance(dimensions, int) else int(np.prod(dimensions))
+            if template is None:
+                self._a = np.zeros(n, dtype=np.float32)
+            else:
+                self._a = np.asarray(template, dtype=np.float32).ravel()
+        def __len__(self):
+            return len(self._a)
+        def __getitem__(self, i):
+            return self._a[i]
+        def __setitem__(self, i, v):
+            self._a[i] = v
+
+    def __init__(self):
+        super().__init__('bgl')
+        self.calls = {}
+
+    def __getattr__(self, name):
+        if name.startswith('GL_'):
+            return name
+        def call(*args):
+            self.calls[name] = self.calls.get(name, 0) + 1
+        return call
+
+class _StubOffscreen:
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+    def bind(self, save=True):
+        pass
+    def unbind(self, restore=True):
+        pass
+    def free(self):
+        pass
+
+def _stub_gpu():
+    gpu = types.ModuleType('gpu')
+    gpu.offscreen = types.SimpleNamespace(new=_StubOffscreen)
+    return gpu
+
+def _stub_mathutils():
+    class Vector(tuple):
+        def __new__(cls, seq):
+            return tuple.__new__(cls, seq)
+        x = property(lambda self: self[0])
+        y = property(lambda self: self[1])
+        def __add__(self, o):
+            return Vector(a+b for a,b in zip(self, o))
+        def __sub__(self, o):
+            return Vector(a-b for a,b in zip(self, o))
+        def __neg__(self):
+            return Vector(-a for a in self)
+        def __mul__(self, k):
+            return Vector(a*k for a in self)
+        def __truediv__(self, k):
+            return Vector(a/k for a in self)
+    mathutils = types.ModuleType('mathutils')
+    mathutils.Vector = Vector
+    return mathutils
+
+def _stub_bpy():
+    class Image:
+        def __init__(self, name, width, height):
+            self.name = name
+            self.size = [width, height]
+            self.pixels = [0.0]*(width*height*4)
+            self.bindcode = [0]
+            self.filepath = ''
+            self._props = {}
+        def __contains__(self, key):
+            return key in self._props
+        def __getitem__(self, key):
+            return self._props[key]
+        def __setitem__(self, key, value):
+            self._props[key] = value
+        def __delitem__(self, key):
+            del self._props[key]
+        def scale(self, width, height):
+            self.size = [width, height]
+            self.pixels = [0.0]*(width*height*4)
+        def gl_load(self, *args):
+            self.bindcode = [1]
+        def gl_touch(self, *args):
+            pass
+        def gl_free(self):
+            self.bindcode = [0]
+
+    class Images(dict):
+        def new(self, name, width, height, **kw):
+            img = self[name] = Image(name, width, height)
+            return img
+        def remove(self, img):
+            del self[img.name]
+
+    class Base:
+        pass
+    bpy = types.ModuleType('bpy')
+    bpy.types = types.SimpleNamespace(Operator=Base, Panel=Base, WindowManager=Base
+                                     , SpaceNodeEditor=Base, Image=Base)
+    bpy.props = types.SimpleNamespace(**{n: (lambda *a, **k: None) for n in
+                 ('BoolProperty', 'IntProperty', 'FloatProperty', 'StringProperty'
+                 , 'EnumProperty', 'FloatVectorProperty', 'PointerProperty')})
+    bpy.data = types.SimpleNamespace(images=Images(), masks={})
+    bpy.utils = types.SimpleNamespace(register_class=lambda c: None, unregister_class=lambda c: None)
+    bpy.app = types.SimpleNamespace(background=True, handlers=types.SimpleNamespace(frame_change_post=[]))
+    bpy.path = types.SimpleNamespace(abspath=lambda p: p)
+    bpy.context = None
+    return bpy
+
+def load_komb():
+    '''
+    import komb.py next to this file with the stubs in place
+    '''
+    stubs = {'bgl': _StubGL(), 'gpu': _stub_gpu()}
+    for name, make in (('bpy', _stub_bpy), ('mathutils', _stub_mathutils)):
+        try:
+            __import__(name)
+        except ImportError:
+            stubs[name] = make()
+    saved = {name: sys.modules.get(name) for name in stubs}
+    sys.modules.update(stubs)
+    try:
+        spec = importlib.util.spec_from_file_location('komb_benched', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'komb.py'))
+        komb = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(komb)
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+    return komb, stubs['bgl']
+
+def make_context(komb, width, height):
+    wm = types.SimpleNamespace(komb_bake_channel=komb.KombChannel.RGBA
+                              , komb_brush_profile=komb.KombBrushProfile.HARD
+                              , komb_bake_engine=komb.KombBakeEngine.GL)
+    space = types.SimpleNamespace(type='NODE_EDITOR', tree_type='CompositorNodeTree'
+                                 , backdrop_x=0.0, backdrop_y=0.0, backdrop_zoom=1.0)
+    return types.SimpleNamespace(window_manager=wm, space_data=space
+                                , area=types.SimpleNamespace(type='NODE_EDITOR')
+                                , region=types.SimpleNamespace(width=1920, height=1080))
+
+def synthetic_points(npoints, width, height, seed=0):
+    '''
+    @return [(n, 3) float32 array, ...] -- random walk strokes over the image, with
+             radii varying along them, split into lines of `POINTS_PER_LINE`
+    '''
+    rng = np.random.RandomState(seed)
+    out = []
+    for start in range(0, npoints, POINTS_PER_LINE):
+        n = min(POINTS_PER_LINE, npoints-start)
+        step = rng.normal(0, max(width, height)/400, (n, 2))
+        p = np.cumsum(step, axis=0) + rng.uniform(-.4, .4, 2)*(width, height)
+        p = np.clip(p, (-width/2, -height/2), (width/2, height/2))
+        r = max(width, height)/200 * (1.5 + np.sin(np.arange(n)/25 + rng.uniform(0, 6)))
+        out.append(np.column_stack((p, r)).astype(np.float32))
+    return out
+
+def make_lines(komb, arrays):
+    lines = []
+    for i, ps in enumerate(arrays):
+        line = komb.KombLine((1.0, 1.0, 1.0) if (i//4) % 2 == 0 else (0.0, 0.0, 0.0))
+        line.seq.extend(ps)
+        lines.append(line)
+    return lines
+
+def measure(run, setup=lambda: None, repeat=3):
+    '''
+    @return (seconds, peak_bytes) -- best time of `repeat` runs; the peak of traced Python
+            and NumPy allocations during one more run.
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        arg = setup()
+        t = time.perf_counter()
+        run(arg)
+        best = min(best, time.perf_counter()-t)
+    arg = setup()
+    tracemalloc.start()
+    try:
+        run(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+def bench(komb, gl, points, sizes, repeat):
+    results = []
+    def record(case, npoints, size, nlines, seconds, peak, **extra):
+        r = dict(case=case, points=npoints, width=size[0], height=size[1], lines=nlines
+                , seconds=round(seconds, 6), peak_bytes=peak)
+        r.update(extra)
+        results.append(r)
+        print('{:<16} {:>8} pts {:>5}x{:<5} {:10.4f} s {:10.1f} MB'.format(
+              case, npoints, size[0], size[1], seconds, peak/2**20), file=sys.stderr)
+
+    for size in sizes:
+        width, height = size
+        context = make_context(komb, width, height)
+        for npoints in points:
+            arrays = synthetic_points(npoints, width, height)
+            nlines = len(arrays)
+
+            ## tessellation, from fresh lines (curve sampling included)
+            s, m = measure(lambda lines: [line.tessellation() for line in lines]
+                          , lambda: make_lines(komb, arrays), repeat)
+            lines = make_lines(komb, arrays)
+            nquads = sum(len(line.tessellation()) for line in lines)
+            record('tessellate', npoints, size, nlines, s, m, quads=nquads)
+
+            ## draw_callback of tessellated lines: batching and vertex submission
+            komb.State.reset()
+            opt = {'center': komb.Vector((context.region.width/2, context.region.height/2))
+                  , 'zoom': 1.0, 'image_size': size, 'draw_backdrop': False, 'lines': lines}
+            gl.calls.clear()
+            s, m = measure(lambda _: komb.draw_callback(None, context, opt), repeat=repeat)
+            record('draw', npoints, size, nlines, s, m, gl_calls=sum(gl.calls.values())//(repeat+1))
+
+            ## viewport draw with culling, index already built
+            komb.State.reset()
+            komb.visible_quads(context, lines, opt['center'], 1.0)
+            opt_view = dict(opt)
+            del opt_view['center']
+            s, m = measure(lambda _: komb.draw_callback(None, context, opt_view), repeat=repeat)
+            record('draw_culled', npoints, size, nlines, s, m)
+
+            ## bakes, each into an image of its own from an empty cache
+            def setup_bake():
+                komb.State.reset()
+                komb.bpy.data.images.pop('bench', None)
+                return make_lines(komb, arrays)
+            s, m = measure(lambda lines: komb.render_offscreen(None, context, width, height, 'bench', lines, False)
+                          , setup_bake, repeat)
+            record('render_offscreen', npoints, size, nlines, s, m)
+            s, m = measure(lambda lines: komb.bake_lines_to_image(lines, width, height, 'bench', False)
+                          , setup_bake, repeat)
+            record('bake_software', npoints, size, nlines, s, m)
+            s, m = measure(lambda lines: komb.bake_multires(lines, width, height, 'bench', MULTIRES_SCALES)
+                          , setup_bake, repeat)
+            record('bake_multires', npoints, size, nlines, s, m, scales=MULTIRES_SCALES)
+
+        ## pixel assembly: image -> cache -> image, independent of the strokes
+        img = komb.prepare_blimage(width, height, 'bench')
+        s, m = measure(lambda _: komb.image_pixels_set(img, komb.image_pixels_get(img)), repeat=repeat)
+        record('pixel_assembly', 0, size, 0, s, m)
+    return results
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Komb benchmark')
+    parser.add_argument('--quick', action='store_true', help='up to 100k points and 1920x1080')
+    parser.add_argument('--points', type=int, nargs='*', help='stroke point counts')
+    parser.add_argument('--sizes', nargs='*', help='image sizes as WxH')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help='JSON file, default stdout')
+    args = parser.parse_args(argv)
+
+    points = args.points or (QUICK_POINTS if args.quick else POINTS)
+    sizes = [tuple(int(v) for v in s.lower().split('x')) for s in args.sizes]  \
+              if args.sizes else (QUICK_SIZES if args.quick else SIZES)
+
+    komb, gl = load_komb()
+    report = {
+        'komb_version': list(komb.bl_info['version']),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': args.repeat,
+        'results': bench(komb, gl, points, sizes, args.repeat),
+        }
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    argv = sys.argv[sys.argv.index('--')+1:] if '--' in sys.argv else sys.argv[1:]
+    main(argv)
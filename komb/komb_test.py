@@ -0,0 +1,67 @@
+'''
+Komb tests -- headless, with the stubs of `komb_bench.py`.
+
+    python komb_test.py
+    blender -b --python komb_test.py
+'''
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from komb_bench import load_komb
+
+
+komb, gl = load_komb()
+
+def make_line(color, points):
+    line = komb.KombLine(color)
+    line.seq.extend(np.array(points, dtype=np.float32))
+    return line
+
+
+class PackedChannelTest(unittest.TestCase):
+    def setUp(self):
+        komb.State.reset()
+        komb.bpy.data.images.pop('packed', None)
+
+    def packed_image(self, width, height):
+        '''
+        R, B, A masks with alpha below 1 (and 0) in a part of the image
+        '''
+        rng = np.random.RandomState(0)
+        pixels = rng.uniform(0, 1, (height, width, 4)).astype(np.float32)
+        pixels[:height//2,:,3] = 0
+        pixels[height//2:,:width//2,3] = .5
+        img = komb.prepare_blimage(width, height, 'packed')
+        komb.image_pixels_set(img, pixels)
+        return img, komb.image_pixels_get(img)
+
+    def test_bake_channel_keeps_other_channels(self):
+        width, height = 64, 48
+        img, before = self.packed_image(width, height)
+        komb.State.img_bake_target = img
+        line = make_line((1.0, 1.0, 1.0), [(-20, -10, 4), (20, 10, 4)])
+        komb.bake_lines_to_image([line], width, height, 'packed', False, channel=komb.KombChannel.G)
+
+        after = komb.image_pixels_get(komb.bpy.data.images['packed'])
+        for c in (0, 2, 3):
+            np.testing.assert_array_equal(after[...,c], before[...,c])
+        self.assertTrue((after[...,1] != before[...,1]).any())
+
+    def test_rgba_bake_composites_over_black(self):
+        width, height = 32, 32
+        img, before = self.packed_image(width, height)
+        komb.State.img_bake_target = img
+        komb.bake_lines_to_image([], width, height, 'packed', False)
+
+        after = komb.image_pixels_get(komb.bpy.data.images['packed'])
+        np.testing.assert_allclose(after[...,:3], before[...,:3]*before[...,3:4], atol=1e-6)
+
+
+if __name__ == '__main__':
+    argv = sys.argv[sys.argv.index('--')+1:] if '--' in sys.argv else sys.argv[1:]
+    unittest.main(argv=[sys.argv[0]]+argv)